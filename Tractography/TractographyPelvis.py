@@ -13,7 +13,6 @@ from subprocess import call
 from joblib import cpu_count
 from vtk.util import numpy_support as ns
 from functions import *
-from functions import filter as ft
 
 
 __author__ = 'Alessandro Delmonte'
@@ -368,11 +367,18 @@ class TractographyPelvisWidget:
         self.radio_ap.setChecked(True)
         self.radio_si = qt.QRadioButton('Superior-Inferior')
         self.radio_ml = qt.QRadioButton('Medial-Lateral')
+        self.radio_all = qt.QRadioButton('All')
         grid_layout3.addWidget(self.radio_ap, 0, 0, 0)
         grid_layout3.addWidget(self.radio_si, 0, 1, 0)
         grid_layout3.addWidget(self.radio_ml, 0, 2, 0)
+        grid_layout3.addWidget(self.radio_all, 0, 3, 0)
         filtersFormLayout.addRow('Principal Direction: ', groupbox3)
 
+        self.check_oblique = qt.QCheckBox()
+        self.check_oblique.setChecked(False)
+        self.check_oblique.toolTip = 'With All, write the fibers far from every axis in a separate oblique bundle.'
+        filtersFormLayout.addRow('Oblique Remainder: ', self.check_oblique)
+
         self.compute_filter = qt.QPushButton('Filter')
         self.compute_filter.toolTip = 'Apply the PQL algorithm to the input tractogram.'
         self.compute_filter.enabled = True
@@ -380,6 +386,53 @@ class TractographyPelvisWidget:
         self.compute_filter.connect('clicked(bool)', self.on_compute_filter)
         filtersFormLayout.addRow(self.compute_filter)
 
+        self.tck_filter_selector = ctk.ctkPathLineEdit()
+        self.tck_filter_selector.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Readable
+        self.tck_filter_selector.nameFilters = ['*.tck']
+        filtersFormLayout.addRow('Input File (.tck): ', self.tck_filter_selector)
+
+        self.compute_tck_filter = qt.QPushButton('Filter File')
+        self.compute_tck_filter.toolTip = 'Apply the filter to a tck file on the disk (e.g. a whole-pelvis ' \
+                                          'tractogram), the bundles are saved next to it.'
+        self.compute_tck_filter.enabled = True
+
+        self.compute_tck_filter.connect('clicked(bool)', self.on_compute_tck_filter)
+        filtersFormLayout.addRow(self.compute_tck_filter)
+
+        self.load_preview = qt.QPushButton('Load Preview')
+        self.load_preview.toolTip = 'Load a spatially stratified subsample of the tck file, refined progressively ' \
+                                    'up to 200k fibers.'
+        self.load_preview.enabled = True
+
+        self.load_preview.connect('clicked(bool)', self.on_load_preview)
+        filtersFormLayout.addRow(self.load_preview)
+
+        self.compute_report = qt.QPushButton('QC Report')
+        self.compute_report.toolTip = 'Statistics of the tck file (count, lengths, directions, bounding box), saved ' \
+                                      'in a json file next to it and shown in a table.'
+        self.compute_report.enabled = True
+
+        self.compute_report.connect('clicked(bool)', self.on_compute_report)
+        filtersFormLayout.addRow(self.compute_report)
+
+        self.sliderCluster = ctk.ctkSliderWidget()
+        self.sliderCluster.decimals = 1
+        self.sliderCluster.minimum = 1.
+        self.sliderCluster.maximum = 50.
+        self.sliderCluster.singleStep = 0.5
+        self.sliderCluster.value = 10.
+        self.sliderCluster.spinBoxVisible = True
+
+        filtersFormLayout.addRow('Cluster Threshold (mm)', self.sliderCluster)
+
+        self.compute_cluster = qt.QPushButton('Cluster')
+        self.compute_cluster.toolTip = 'Split the input fiber bundle in QuickBundles clusters, one fiber bundle ' \
+                                       'per cluster.'
+        self.compute_cluster.enabled = True
+
+        self.compute_cluster.connect('clicked(bool)', self.on_compute_cluster)
+        filtersFormLayout.addRow(self.compute_cluster)
+
         self.layout.addStretch(1)
 
         if self.developerMode:
@@ -466,7 +519,7 @@ class TractographyPelvisWidget:
             properties = {}
             properties['useCompression'] = 0
             if (not self.radio_whole.isChecked()) and self.radio_p.isChecked():
-                label_list = [n for n in range(15, 28)] + [n for n in range(7, 10)]
+                label_list = IMAG2_LABELS
                 temp_seed_node = slicer.vtkSlicerVolumesLogic().CloneVolume(slicer.mrmlScene, self.seedsNode, 'out',
                                                                             True)
                 parc = np.copy(slicer.util.arrayFromVolume(self.seedsNode))
@@ -488,74 +541,111 @@ class TractographyPelvisWidget:
             else:
                 excl_path = None
 
-            path = self.logic.tracts(self.sliderLength.minimumValue, self.sliderLength.maximumValue,
-                                     self.sliderCutoff.value, self.sliderSeeds.value, self.sliderMaxangle.value,
-                                     data_path, mask_path, seeds_path,
-                                     excl_path, bvec_path, bval_path, self.combo_tract.currentIndex,
-                                     self.radio_whole.isChecked())
+            result = self.logic.tracts(self.sliderLength.minimumValue, self.sliderLength.maximumValue,
+                                       self.sliderCutoff.value, self.sliderSeeds.value, self.sliderMaxangle.value,
+                                       data_path, mask_path, seeds_path,
+                                       excl_path, bvec_path, bval_path, self.combo_tract.currentIndex,
+                                       self.radio_whole.isChecked())
 
             if not self.radio_whole.isChecked():
                 tractoname = self.tractoNode.GetName()
 
                 slicer.mrmlScene.RemoveNode(self.tractoNode)
 
-                success, self.upNode = slicer.util.loadFiberBundle(path, True)
-                self.upNode.SetName(tractoname)
+                self.upNode = self.logic.fiber_bundle_node(result, tractoname)
                 self.tractoSelector.setCurrentNode(self.upNode)
-
-                fiber_nodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLFiberBundleNode')
-                fiber_nodes.UnRegister(slicer.mrmlScene)
-                fiber_nodes.InitTraversal()
-                fiber_node = fiber_nodes.GetNextItemAsObject()
-                while fiber_node:
-                    if fiber_node is not self.upNode:
-                        fiber_node.GetLineDisplayNode().SetVisibility(0)
-                        fiber_node.GetTubeDisplayNode().SetVisibility(0)
-                        fiber_node.GetGlyphDisplayNode().SetVisibility(0)
-                    fiber_node = fiber_nodes.GetNextItemAsObject()
+                self.show_only([self.upNode])
             else:
                 self.output_file_selector.addCurrentPathToHistory()
                 new_path = self.output_file_selector.currentPath.encode('utf-8')
-                shutil.move(path, new_path)
+                shutil.move(result, new_path)
 
             self.cleanup()
 
     def on_compute_filter(self):
         if self.tractofiltersNode and self.outfiltersNode:
-            properties = {}
-            properties['useCompression'] = 0
-            tracto_path = os.path.join(self.logic.tmp, 'tracto.vtk')
-            slicer.util.saveNode(self.tractofiltersNode, tracto_path, properties)
-
             outputname = self.outfiltersNode.GetName()
 
             if self.radio_ml.isChecked():
                 dir = 0
             elif self.radio_ap.isChecked():
                 dir = 1
-            else:
+            elif self.radio_si.isChecked():
                 dir = 2
+            else:
+                dir = None
 
-            path = self.logic.filter(tracto_path, dir)
+            oblique = self.logic.oblique if self.check_oblique.isChecked() else None
+            polydata = self.logic.filter(self.tractofiltersNode.GetPolyData(), dir, oblique)
 
             slicer.mrmlScene.RemoveNode(self.outfiltersNode)
 
-            success, self.upNode = slicer.util.loadFiberBundle(path, True)
-            self.upNode.SetName(outputname)
+            if dir is not None:
+                self.upNode = self.logic.fiber_bundle_node(polydata, outputname)
+                new_nodes = [self.upNode]
+            else:
+                new_nodes = [self.logic.fiber_bundle_node(bundle, outputname + '_' + name)
+                             for name, bundle in zip(DIRECTION_NAMES, polydata)]
+                self.upNode = new_nodes[0]
             self.outfiltersSelector.setCurrentNode(self.upNode)
+            self.show_only(new_nodes)
+
+    def on_compute_cluster(self):
+        if self.tractofiltersNode and self.outfiltersNode:
+            outputname = self.outfiltersNode.GetName()
+            bundles = self.logic.cluster(self.tractofiltersNode.GetPolyData(), self.sliderCluster.value)
 
-            fiber_nodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLFiberBundleNode')
-            fiber_nodes.UnRegister(slicer.mrmlScene)
-            fiber_nodes.InitTraversal()
+            slicer.mrmlScene.RemoveNode(self.outfiltersNode)
+
+            new_nodes = [self.logic.fiber_bundle_node(bundle, outputname + '_' + str(rank))
+                         for rank, bundle in enumerate(bundles)]
+            if new_nodes:
+                self.upNode = new_nodes[0]
+                self.outfiltersSelector.setCurrentNode(self.upNode)
+            self.show_only(new_nodes)
+
+    def show_only(self, new_nodes):
+        fiber_nodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLFiberBundleNode')
+        fiber_nodes.UnRegister(slicer.mrmlScene)
+        fiber_nodes.InitTraversal()
+        fiber_node = fiber_nodes.GetNextItemAsObject()
+        while fiber_node:
+            if not any(fiber_node is node for node in new_nodes):
+                fiber_node.GetLineDisplayNode().SetVisibility(0)
+                fiber_node.GetTubeDisplayNode().SetVisibility(0)
+                fiber_node.GetGlyphDisplayNode().SetVisibility(0)
             fiber_node = fiber_nodes.GetNextItemAsObject()
-            while fiber_node:
-                if fiber_node is not self.upNode:
-                    fiber_node.GetLineDisplayNode().SetVisibility(0)
-                    fiber_node.GetTubeDisplayNode().SetVisibility(0)
-                    fiber_node.GetGlyphDisplayNode().SetVisibility(0)
-                fiber_node = fiber_nodes.GetNextItemAsObject()
 
-            self.cleanup()
+    def on_compute_tck_filter(self):
+        in_path = self.tck_filter_selector.currentPath
+        if in_path and os.path.isfile(in_path):
+            self.tck_filter_selector.addCurrentPathToHistory()
+
+            if self.radio_ml.isChecked():
+                dir = 0
+            elif self.radio_ap.isChecked():
+                dir = 1
+            elif self.radio_si.isChecked():
+                dir = 2
+            else:
+                dir = None
+
+            oblique = self.logic.oblique if self.check_oblique.isChecked() else None
+            paths = self.logic.filter_tck(in_path, dir, oblique)
+            print('Filtered tractograms: ' + ', '.join(paths))
+
+    def on_load_preview(self):
+        in_path = self.tck_filter_selector.currentPath
+        if in_path and os.path.isfile(in_path):
+            self.tck_filter_selector.addCurrentPathToHistory()
+            name, _ = os.path.splitext(os.path.basename(in_path))
+            self.logic.load_preview(in_path, name)
+
+    def on_compute_report(self):
+        in_path = self.tck_filter_selector.currentPath
+        if in_path and os.path.isfile(in_path):
+            self.tck_filter_selector.addCurrentPathToHistory()
+            self.logic.report(in_path)
 
     def onReload(self):
 
@@ -609,6 +699,12 @@ class TractographyPelvisLogic:
 
         self.tmp = tempfile.mkdtemp()
         self.my_env = slicer.util.startupEnvironment()
+        self.oblique = 0.8
+        self.min_cluster_size = 10
+        self.preview_size = 5000
+        self.preview_step = 25000
+        self.preview_max = 200000
+        self.preview_interval = 100
 
     def __del__(self):
         shutil.rmtree(self.tmp)
@@ -689,16 +785,136 @@ class TractographyPelvisLogic:
             pipe(string, True, self.my_env)
 
         if not is_whole:
-            final_path = tck2vtk(os.path.join(self.tmp, 'tracto.tck'))
-        else:
-            final_path = os.path.join(self.tmp, 'tracto.tck')
+            return tracts_to_vtkpolydata(read_tck(os.path.join(self.tmp, 'tracto.tck'))[0])
+
+        return os.path.join(self.tmp, 'tracto.tck')
+
+    def fiber_bundle_node(self, polydata, name):
+        node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLFiberBundleNode', name)
+        node.SetAndObservePolyData(polydata)
+        node.CreateDefaultDisplayNodes()
+        return node
+
+    def filter(self, polydata, dir, oblique=None):
+        fibers, data = vtkpolydata_to_tracts(polydata)
+        if dir is not None:
+            return subset_polydata(fibers, data, principal_directions(fibers) == dir)
+
+        classes = direction_classes(fibers, oblique)
+        return [subset_polydata(fibers, data, classes == n) for n in range(3 if oblique is None else 4)]
+
+    def filter_tck(self, in_path, dir, oblique=None):
+        file_name, _ = os.path.splitext(in_path)
+        out_paths = [file_name + '_' + name + '.tck' for name in DIRECTION_NAMES]
+        if oblique is None:
+            out_paths = out_paths[:3]
+        if dir is not None:
+            #a single direction keeps its oblique fibers, as in filter
+            out_paths = [path if n == dir else None for n, path in enumerate(out_paths[:3])]
+            oblique = None
+        split_directions_tck(in_path, out_paths, oblique)
+        return [path for path in out_paths if path]
+
+    def cluster(self, polydata, threshold):
+        fibers, data = vtkpolydata_to_tracts(polydata)
+        labels, _ = quickbundles(fibers, threshold)
+        return [subset_polydata(fibers, data, labels == label)
+                for label in bundle_labels(labels, self.min_cluster_size)]
+
+    def connectivity(self, tck_path, labels_node, fa_node=None):
+        maps = []
+        for node in (labels_node, fa_node):
+            if node is None:
+                maps.append(None)
+                continue
+            ijk_to_ras = vtk.vtkMatrix4x4()
+            node.GetIJKToRASMatrix(ijk_to_ras)
+            maps.append((slicer.util.arrayFromVolume(node).transpose(2, 1, 0), vtkmatrix_to_numpy(ijk_to_ras)))
+        labelmap, affine = maps[0]
+        matrices = connectivity_matrix(iter_tck(tck_path), labelmap, affine, scalar=maps[1])
+
+        file_name, _ = os.path.splitext(tck_path)
+        header = ','.join(str(label) for label in IMAG2_LABELS)
+        for name, matrix in matrices.items():
+            np.savetxt(file_name + '_connectome_' + name + '.csv', matrix, delimiter=',', header=header)
+        return matrices
+
+    def load_preview(self, tck_path, name):
+        streamlines, _ = read_tck(tck_path, lazy=True)
+        levels = level_of_detail(streamlines, self.preview_size, max_step=self.preview_step,
+                                 max_count=self.preview_max)
+        polydata = PolyDataBuffer()
+        node = self.fiber_bundle_node(polydata.append(next(levels)), name)
+
+        #the next fibers are added from the event loop, a bounded batch at a time, so the scene stays usable
+        def refine():
+            if node.GetScene() is None:
+                return
+            try:
+                batch = next(levels)
+            except StopIteration:
+                return
+            polydata.append(batch)
+            node.SetAndObservePolyData(polydata.polydata)
+            qt.QTimer.singleShot(self.preview_interval, refine)
+
+        qt.QTimer.singleShot(self.preview_interval, refine)
+        return node
+
+    def register_tck(self, tck_path, affine_path, inverse_warp_path=None):
+        #ANTs transforms map the fixed (T2) points to the moving (DWI) ones: the DWI space streamlines go through
+        #the inverse affine then the inverse warp
+        affine = np.linalg.inv(read_ants_affine(affine_path))
+        field, field_affine = read_ants_warp(inverse_warp_path) if inverse_warp_path else (None, None)
+        file_name, _ = os.path.splitext(tck_path)
+        out_path = file_name + '_registered.tck'
+        transform_tck(tck_path, out_path, affine, field, field_affine)
+        return out_path
 
-        return final_path
+    def report(self, tck_path, table=True):
+        file_name, _ = os.path.splitext(tck_path)
+        report = tck_report(tck_path, file_name + '_report.json', oblique=self.oblique)
+        if not table:
+            return report
 
-    def filter(self, in_path, dir):
-        out_path = os.path.join(self.tmp, 'filter.vtk')
-        ft(in_path, out_path, dir)
-        return out_path
+        rows = []
+
+        def flatten(prefix, value):
+            if isinstance(value, dict):
+                for key in value:
+                    if key != 'histogram':
+                        flatten((prefix + ' ' + key).strip(), value[key])
+            else:
+                rows.append((prefix, value))
+
+        flatten('', report)
+        table_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', os.path.basename(file_name) + '_report')
+        names = vtk.vtkStringArray()
+        names.SetName('Statistic')
+        values = vtk.vtkStringArray()
+        values.SetName('Value')
+        for name, value in rows:
+            names.InsertNextValue(name)
+            values.InsertNextValue(str(value))
+        table_node.GetTable().AddColumn(names)
+        table_node.GetTable().AddColumn(values)
+        return report
+
+    def density(self, tck_path, reference_node, endpoints=False, name='TrackDensity'):
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        reference_node.GetIJKToRASMatrix(ijk_to_ras)
+        affine = vtkmatrix_to_numpy(ijk_to_ras)
+        shape = reference_node.GetImageData().GetDimensions()
+        if endpoints:
+            counts = endpoint_density(iter_tck(tck_path), affine, shape)
+        else:
+            counts = track_density(iter_tck(tck_path), affine, shape)
+
+        volume_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+        volume_node.SetIJKToRASMatrix(ijk_to_ras)
+        slicer.util.updateVolumeFromArray(volume_node, counts.transpose(2, 1, 0))
+        volume_node.CreateDefaultDisplayNodes()
+        return volume_node
 
 
 class TractographyPelvisTest(unittest.TestCase):
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from functions import read_tck, read_vtk, save_tck, save_vtk, save_trx, read_trx
+from common import setup
+
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+
+def main():
+    streamlines = setup('Tractogram storage: size and load time of tck, vtk and trx', field_of_view=200.)
+    tmp = tempfile.mkdtemp()
+    try:
+        formats = [('tck', 'tracto.tck', lambda path: save_tck(path, streamlines),
+                    lambda path: read_tck(path)[0]),
+                   ('vtk', 'tracto.vtk', lambda path: save_vtk(path, streamlines),
+                    lambda path: read_vtk(path)[0].pack()),
+                   ('trx float16', 'float16.trx', lambda path: save_trx(path, streamlines),
+                    lambda path: read_trx(path)[0].pack()),
+                   ('trx float16 zip', 'float16_zip.trx', lambda path: save_trx(path, streamlines, compress=True),
+                    lambda path: read_trx(path)[0].pack()),
+                   ('trx delta zip', 'delta_zip.trx',
+                    lambda path: save_trx(path, streamlines, encoding='delta', compress=True),
+                    lambda path: read_trx(path)[0].pack())]
+
+        print('{} streamlines, {} points'.format(len(streamlines), streamlines.number_of_points))
+        print('{:<16} {:>10} {:>9} {:>9} {:>10}'.format('format', 'size (MB)', 'write (s)', 'load (s)', 'error (mm)'))
+        for name, file_name, write, load in formats:
+            path = os.path.join(tmp, file_name)
+            start = time.time()
+            write(path)
+            time_write = time.time() - start
+
+            start = time.time()
+            loaded = load(path)
+            time_load = time.time() - start
+
+            error = np.abs(loaded.points.astype(np.float64) - streamlines.points).max()
+            print('{:<16} {:>10.1f} {:>9.2f} {:>9.2f} {:>10.4f}'.format(name, os.path.getsize(path) / 2. ** 20,
+                                                                       time_write, time_load, error))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
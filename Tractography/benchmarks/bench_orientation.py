@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import numpy as np
+from dipy.tracking.metrics import mean_orientation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from functions import principal_directions
+from common import setup
+
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+
+def main():
+    streamlines = setup('Principal direction classification: dipy per-fiber vs packed')
+
+    start = time.time()
+    princ_dipy = np.array([abs(x).argmax() for x in [mean_orientation(f) for f in streamlines]])
+    time_dipy = time.time() - start
+
+    start = time.time()
+    princ = principal_directions(streamlines)
+    time_packed = time.time() - start
+
+    print('{} streamlines, {} points'.format(len(streamlines), streamlines.number_of_points))
+    print('dipy per-fiber: {:.3f} s'.format(time_dipy))
+    print('packed:         {:.3f} s ({:.0f}x)'.format(time_packed, time_dipy / max(time_packed, 1e-9)))
+    print('identical classification: {}'.format(np.array_equal(princ, princ_dipy)))
+
+
+if __name__ == '__main__':
+    main()
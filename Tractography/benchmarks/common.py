@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from functions import read_tck, read_vtk, as_streamlines
+
+
+__author__ = 'Alessandro Delmonte'
+__email__ = 'delmonte.ale92@gmail.com'
+
+
+def synthetic(count, seed=0, field_of_view=None):
+    """
+    Random walk streamlines of 20 to 200 points with a 1 mm step
+    :param count: number of streamlines
+    :param seed: random seed
+    :param field_of_view: size (mm) of the box every streamline starts in, one continuous walk when None
+    :return: Streamlines
+    """
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(20, 200, count)
+    steps = rng.randn(count, 3)
+    steps = np.repeat(steps / np.linalg.norm(steps, axis=1)[:, None], lengths, axis=0)
+    points = np.cumsum(steps + 0.3 * rng.randn(*steps.shape), axis=0)
+    if field_of_view is not None:
+        firsts = np.cumsum(lengths) - lengths
+        starts = rng.uniform(-field_of_view / 2., field_of_view / 2., (count, 3))
+        points += np.repeat(starts - points[firsts], lengths, axis=0)
+    return as_streamlines(np.split(points.astype(np.float32), np.cumsum(lengths)[:-1]))
+
+
+def setup(description, field_of_view=None):
+    """
+    Command line of the benchmarks: a tck or vtk tractogram, or synthetic streamlines
+    :param description: benchmark description shown by --help
+    :param field_of_view: see synthetic
+    :return: packed Streamlines
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--input', type=str, help='tck or vtk tractogram, synthetic if not given')
+    parser.add_argument('-n', '--count', type=int, default=100000, help='number of synthetic streamlines')
+    args = parser.parse_args()
+
+    if args.input is None:
+        return synthetic(args.count, field_of_view=field_of_view).pack()
+    if args.input.endswith('.tck'):
+        return read_tck(args.input)[0]
+    return read_vtk(args.input)[0].pack()
@@ -1,2 +1,13 @@
+from .clustering import *
+from .connectivity import *
+from .density import *
 from .input_output import *
 from .logic import *
+from .metrics import *
+from .parallel import *
+from .report import *
+from .sampling import *
+from .selection import *
+from .streamlines import *
+from .transforms import *
+from .voxel_index import *
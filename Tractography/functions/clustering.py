@@ -0,0 +1,194 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from .streamlines import as_streamlines
+from .metrics import resample
+
+
+def mdf_distances(streamlines, centroids, rows, cols, chunk_size=100000):
+    """
+    Minimum average direct-flip distance between pairs of fixed-length streamlines
+    :param streamlines: (N, P, 3) resampled streamlines
+    :param centroids: (K, P, 3) resampled centroids
+    :param rows: streamline index of every pair
+    :param cols: centroid index of every pair
+    :param chunk_size: number of pairs computed at once
+    :return: (M,) distances, (M,) True where the flipped streamline is the closest
+    """
+    distances = np.empty(len(rows))
+    flipped = np.empty(len(rows), dtype=bool)
+    for start in range(0, len(rows), chunk_size):
+        a = streamlines[rows[start:start + chunk_size]]
+        b = centroids[cols[start:start + chunk_size]]
+        direct = np.linalg.norm(a - b, axis=2).mean(axis=1)
+        reverse = np.linalg.norm(a - b[:, ::-1], axis=2).mean(axis=1)
+        distances[start:start + chunk_size] = np.minimum(direct, reverse)
+        flipped[start:start + chunk_size] = reverse < direct
+    return distances, flipped
+
+
+def nearest_centroids(streamlines, centroids, threshold, use_kdtree=True):
+    """
+    Closest centroid of every streamline, among the ones within the MDF threshold
+    :param streamlines: (N, P, 3) resampled streamlines
+    :param centroids: (K, P, 3) resampled centroids
+    :param threshold: maximum MDF distance
+    :param use_kdtree: prune the pairs with a KD-tree on the mean points, the distance between the mean points of two
+    streamlines being a lower bound of their MDF distance
+    :return: streamline indices having a centroid within the threshold, their centroid, True where it is flipped
+    """
+    if use_kdtree:
+        pairs = cKDTree(streamlines.mean(axis=1)).sparse_distance_matrix(
+            cKDTree(centroids.mean(axis=1)), threshold, output_type='ndarray')
+        rows, cols = pairs['i'].astype(np.int64), pairs['j'].astype(np.int64)
+    else:
+        rows = np.repeat(np.arange(len(streamlines)), len(centroids))
+        cols = np.tile(np.arange(len(centroids)), len(streamlines))
+    distances, flipped = mdf_distances(streamlines, centroids, rows, cols)
+    close = distances < threshold
+    rows, cols, distances, flipped = rows[close], cols[close], distances[close], flipped[close]
+    #first pair of every streamline once sorted by streamline then distance
+    order = np.lexsort((distances, rows))
+    rows, cols, flipped = rows[order], cols[order], flipped[order]
+    best = np.r_[True, rows[1:] != rows[:-1]][:len(rows)]
+    return rows[best], cols[best], flipped[best]
+
+
+def quickbundles(streamlines, threshold=10., n_points=12, block_size=2000, use_kdtree=True):
+    """
+    QuickBundles clustering on the MDF distance, vectorized by blocks. Every streamline of a block is assigned to the
+    closest centroid as it was at the beginning of the block. The streamlines matching none of them are seeds of new
+    clusters in block order (a streamline within the threshold of an earlier seed is not a seed) and are then
+    assigned to the closest seed
+    :param streamlines: Streamlines or list of arrays
+    :param threshold: maximum MDF distance (mm) between a streamline and the centroid of its cluster
+    :param n_points: number of points of the resampled streamlines
+    :param block_size: number of streamlines assigned at once
+    :param use_kdtree: prune the centroids with a KD-tree, see nearest_centroids
+    :return: (N,) cluster labels, -1 for the empty streamlines, (K, n_points, 3) centroids
+    """
+    streamlines = as_streamlines(streamlines)
+    nonempty = np.flatnonzero(streamlines.lengths > 0)
+    resampled = resample(streamlines[nonempty], n_points).points.reshape(-1, n_points, 3)
+    labels = np.empty(len(resampled), dtype=np.int64)
+    sums = np.zeros((0, n_points, 3))
+    counts = np.zeros(0, dtype=np.int64)
+
+    for start in range(0, len(resampled), block_size):
+        block = resampled[start:start + block_size].astype(np.float64)
+        remaining = np.arange(len(block))
+        if len(counts):
+            centroids = sums / counts[:, None, None]
+            rows, cols, flipped = nearest_centroids(block, centroids, threshold, use_kdtree)
+            labels[start + rows] = cols
+            aligned = block[rows]
+            aligned[flipped] = aligned[flipped, ::-1]
+            np.add.at(sums, cols, aligned)
+            counts += np.bincount(cols, minlength=len(counts))
+            remaining = np.setdiff1d(remaining, rows, assume_unique=True)
+        if not len(remaining):
+            continue
+
+        seeds = []
+        unmatched = block[remaining]
+        candidates = np.arange(len(remaining))
+        while len(candidates):
+            seed = candidates[0]
+            seeds.append(seed)
+            distances, _ = mdf_distances(unmatched, unmatched, candidates, np.full(len(candidates), seed))
+            candidates = candidates[distances >= threshold]
+        rows, cols, flipped = nearest_centroids(unmatched, unmatched[seeds], threshold, use_kdtree)
+        aligned = unmatched[rows]
+        aligned[flipped] = aligned[flipped, ::-1]
+        new_sums = np.zeros((len(seeds), n_points, 3))
+        np.add.at(new_sums, cols, aligned)
+        labels[start + remaining[rows]] = cols + len(counts)
+        sums = np.concatenate((sums, new_sums))
+        counts = np.concatenate((counts, np.bincount(cols, minlength=len(seeds))))
+
+    centroids = (sums / counts[:, None, None]).astype(np.float32)
+    all_labels = np.full(len(streamlines), -1, dtype=np.int64)
+    all_labels[nonempty] = labels
+    return all_labels, centroids
+
+
+def split_by_labels(streamlines, labels, min_size=1):
+    """
+    Bundles of a clustered tractogram, largest first
+    :param streamlines: Streamlines or list of arrays
+    :param labels: (N,) cluster labels, see quickbundles
+    :param min_size: smallest number of streamlines of a returned bundle
+    :return: list of Streamlines
+    """
+    streamlines = as_streamlines(streamlines)
+    return [streamlines[labels == label] for label in bundle_labels(labels, min_size)]
+
+
+def bundle_labels(labels, min_size=1):
+    """
+    Cluster labels by decreasing size
+    :param labels: (N,) cluster labels, see quickbundles, the negative ones are not clusters
+    :param min_size: smallest number of streamlines of a returned cluster
+    :return: labels array
+    """
+    labels = np.asarray(labels)
+    sizes = np.bincount(labels[labels >= 0])
+    order = np.argsort(-sizes, kind='mergesort')
+    return order[sizes[order] >= min_size]
+
+
+def unique_streamlines(streamlines, tolerance=0.5, n_points=12):
+    """
+    Duplicate and near-duplicate detection, whatever the streamlines orientation. The resampled streamlines are
+    first quantized on a grid fine enough for two points of a cell to be closer than the tolerance, oriented so that
+    the quantized sequence is the smallest of its two directions and hashed: the exact duplicates share a hash. The
+    near-duplicates are then confirmed on the MDF distance between the first streamlines of every hash, candidate
+    pairs being pruned with a KD-tree on the mean points. Every streamline is collapsed on the earliest kept
+    streamline within the tolerance. The empty streamlines are not resampled, they form one group of their own
+    :param streamlines: Streamlines or list of arrays
+    :param tolerance: maximum MDF distance (mm) between two duplicates
+    :param n_points: number of points of the resampled streamlines
+    :return: sorted indices of the kept streamlines (first of every group), number of streamlines of every group
+    """
+    streamlines = as_streamlines(streamlines)
+    if not len(streamlines):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    empty = np.flatnonzero(streamlines.lengths == 0)
+    if len(empty):
+        nonempty = np.flatnonzero(streamlines.lengths > 0)
+        kept, counts = unique_streamlines(streamlines[nonempty], tolerance, n_points)
+        kept, counts = np.r_[empty[0], nonempty[kept]], np.r_[len(empty), counts]
+        order = np.argsort(kept)
+        return kept[order], counts[order]
+    resampled = resample(streamlines, n_points).points.reshape(-1, n_points * 3)
+    direct = np.rint(resampled / (tolerance / np.sqrt(3.))).astype(np.int64)
+    reverse = direct.reshape(-1, n_points, 3)[:, ::-1].reshape(-1, n_points * 3)
+    #first differing coordinate decides which direction is the smallest
+    differences = direct - reverse
+    first = np.argmax(differences != 0, axis=1)
+    flip = differences[np.arange(len(direct)), first] > 0
+    direct[flip] = reverse[flip]
+
+    multipliers = np.random.RandomState(0).randint(1, 2 ** 62, n_points * 3, dtype=np.int64) | 1
+    with np.errstate(over='ignore'):
+        keys = (direct * multipliers).sum(axis=1)
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    kept = order[starts]
+    sorting = np.argsort(kept)
+    kept, counts = kept[sorting], counts[sorting]
+
+    #near-duplicates of different hashes, the pairs come out with i < j in the kept order
+    representatives = resampled[kept].reshape(-1, n_points, 3).astype(np.float64)
+    pairs = cKDTree(representatives.mean(axis=1)).query_pairs(tolerance, output_type='ndarray')
+    distances, _ = mdf_distances(representatives, representatives, pairs[:, 0], pairs[:, 1])
+    pairs = pairs[distances <= tolerance]
+    pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+    #by increasing j, the status of every i < j is final: j joins the earliest kept streamline close to it
+    leaders = np.arange(len(kept))
+    for i, j in pairs.tolist():
+        if leaders[j] == j and leaders[i] == i:
+            leaders[j] = i
+    selected = leaders == np.arange(len(kept))
+    return kept[selected], np.bincount(leaders, counts, minlength=len(kept))[selected].astype(np.int64)
@@ -0,0 +1,62 @@
+import numpy as np
+from .streamlines import iter_batches
+from .sampling import lookup, trilinear, streamline_means
+from .metrics import streamline_lengths
+
+
+#IMAG2 parcellation labels of the pelvic nerves and plexus, used as seeds and connectivity nodes
+IMAG2_LABELS = list(range(15, 28)) + list(range(7, 10))
+
+
+def connectivity_matrix(streamlines, labelmap, affine, labels=IMAG2_LABELS, scalar=None, chunk_size=50000):
+    """
+    Endpoint connectivity of a tractogram, both endpoints of every streamline are looked up in the labelmap at once.
+    The streamlines with an endpoint outside of the listed labels are not counted
+    :param streamlines: Streamlines, list of arrays or iterable of Streamlines batches (e.g. iter_tck)
+    :param labelmap: 3D integer array
+    :param affine: voxel to world matrix of the labelmap
+    :param labels: node labels, in the matrices order
+    :param scalar: (3D array, affine) map (e.g. FA) averaged along every streamline, then over every edge
+    :param chunk_size: number of streamlines processed at once
+    :return: dictionary with the symmetric (L, L) 'count', 'length' (mean length, mm) and, with a scalar map,
+    'scalar' (mean value) matrices, the means are NaN for the unconnected pairs
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    labelmap = np.asarray(labelmap).astype(np.int64)
+    n = len(labels)
+    #label value to node index, -1 for the other labels and for the points outside (last entry)
+    nodes = np.full(max(labels.max(), labelmap.max()) + 2, -1, dtype=np.int64)
+    nodes[labels] = np.arange(n)
+    if scalar is not None:
+        scalar = (np.asarray(scalar[0], dtype=np.float32), scalar[1])
+
+    counts = np.zeros(n * n)
+    length_sums = np.zeros(n * n)
+    scalar_sums = np.zeros(n * n)
+    for chunk in iter_batches(streamlines, chunk_size):
+        chunk = chunk[chunk.lengths > 0]
+        first = chunk.offsets
+        last = first + chunk.lengths - 1
+        values = lookup(labelmap, np.concatenate((chunk.points[first], chunk.points[last])), affine, outside=-1)
+        ends = nodes[values].reshape(2, -1)
+        connected = np.all(ends >= 0, axis=0)
+        chunk = chunk[connected]
+        edges = ends.min(axis=0)[connected] * n + ends.max(axis=0)[connected]
+
+        counts += np.bincount(edges, minlength=n * n)
+        length_sums += np.bincount(edges, streamline_lengths(chunk), minlength=n * n)
+        if scalar is not None:
+            points = chunk.pack().points
+            means = streamline_means(chunk, trilinear(scalar[0], points, scalar[1]))
+            scalar_sums += np.bincount(edges, means, minlength=n * n)
+
+    counts = counts.reshape(n, n)
+    counts = counts + np.triu(counts, 1).T
+    with np.errstate(invalid='ignore'):
+        result = {'count': counts.astype(np.int64)}
+        length_sums = length_sums.reshape(n, n)
+        result['length'] = (length_sums + np.triu(length_sums, 1).T) / counts
+        if scalar is not None:
+            scalar_sums = scalar_sums.reshape(n, n)
+            result['scalar'] = (scalar_sums + np.triu(scalar_sums, 1).T) / counts
+    return result
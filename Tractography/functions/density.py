@@ -0,0 +1,50 @@
+import numpy as np
+from .streamlines import iter_batches
+from .sampling import voxel_indices, voxel_streamline_pairs
+
+
+def track_density(streamlines, affine, shape, step=None, chunk_size=50000, out=None):
+    """
+    Track density image, number of streamlines crossing every voxel
+    :param streamlines: Streamlines, list of arrays or iterable of Streamlines batches (e.g. iter_tck)
+    :param affine: voxel to world matrix of the output grid
+    :param shape: output grid shape
+    :param step: sampling distance along the segments, exact voxel traversal by default
+    :param chunk_size: number of streamlines voxelized at once
+    :param out: int array of the grid shape the counts are added to, for accumulations over several calls
+    :return: counts array
+    """
+    shape = tuple(int(n) for n in shape[:3])
+    if out is None:
+        out = np.zeros(shape, dtype=np.int32)
+    flat_out = out.reshape(-1)
+
+    for chunk in iter_batches(streamlines, chunk_size):
+        flat, _ = voxel_streamline_pairs(chunk, affine, shape, step)
+        flat_out += np.bincount(flat, minlength=flat_out.size).astype(out.dtype)
+    return out
+
+
+def endpoint_density(streamlines, affine, shape, chunk_size=50000, out=None):
+    """
+    Endpoint density image, number of streamline endpoints in every voxel
+    :param streamlines: Streamlines, list of arrays or iterable of Streamlines batches (e.g. iter_tck)
+    :param affine: voxel to world matrix of the output grid
+    :param shape: output grid shape
+    :param chunk_size: number of streamlines processed at once
+    :param out: int array of the grid shape the counts are added to, for accumulations over several calls
+    :return: counts array
+    """
+    shape = tuple(int(n) for n in shape[:3])
+    if out is None:
+        out = np.zeros(shape, dtype=np.int32)
+    flat_out = out.reshape(-1)
+
+    for chunk in iter_batches(streamlines, chunk_size):
+        chunk = chunk[chunk.lengths > 0]
+        first = chunk.offsets
+        last = first + chunk.lengths - 1
+        ijk, inside = voxel_indices(np.concatenate((chunk.points[first], chunk.points[last])), affine, shape)
+        flat = np.ravel_multi_index(tuple(ijk[inside].T), shape)
+        flat_out += np.bincount(flat, minlength=flat_out.size).astype(out.dtype)
+    return out
@@ -1,10 +1,14 @@
 import vtk
+import json
+import struct
 import os.path
+import zipfile
 import numpy as np
 import nibabel as nib
 from six import iteritems
 from vtk.util import numpy_support as ns
 from nibabel.streamlines.tck import TckFile as tck
+from .streamlines import Streamlines, lengths_to_offsets, as_streamlines
 
 
 def read_vtk(filename):
@@ -21,64 +25,136 @@ def read_vtk(filename):
     return vtkpolydata_to_tracts(polydata)
 
 
-def tck2vtk(path_tck):
-    streamlines, _ = read_tck(path_tck)
+def tck2vtk(path_tck, stream=True):
     file_name, _ = os.path.splitext(path_tck)
     path_vtk = file_name + '.vtk'
-    save_vtk(path_vtk, streamlines)
+    if stream:
+        streamlines, _ = read_tck(path_tck, lazy=True)
+        save_vtk_streamed(path_vtk, streamlines)
+    else:
+        streamlines, _ = read_tck(path_tck)
+        save_vtk(path_vtk, streamlines)
     return path_vtk
 
 
-def read_tck(filename):
+def read_tck(filename, lazy=False):
     header = read_mrtrix_header(filename)
 
-    vertices, line_starts, line_ends = read_mrtrix_streamlines(filename, header)
-    streamlines = []
-    for s, e in zip(line_starts, line_ends):
-        streamlines.append(vertices[s:e, :])
+    if lazy:
+        return read_mrtrix_streamlines_lazy(filename, header), header
+
+    return read_mrtrix_streamlines_lazy(filename, header).pack(), header
+
 
-    return streamlines, header
+_header_cache = {}
+
+
+def read_mrtrix_header(in_file, cache_file=None):
+    """
+    tck header, kept in memory (and optionally in a json file) until the file size or modification time change
+    :param in_file: tck file path
+    :param cache_file: optional json file where the headers are also stored between sessions
+    :return: header dictionary, with the byte offset of the data, the file size and the number of stored triplets
+    """
+    return read_mrtrix_headers([in_file], cache_file)[0]
 
 
-def read_mrtrix_header(in_file):
-    fileobj = open(in_file, "rb")
+def read_mrtrix_headers(in_files, cache_file=None):
+    """
+    tck headers of a batch of files, the json cache file is read once and written once, if any entry changed
+    :param in_files: tck file paths
+    :param cache_file: optional json file where the headers are also stored between sessions
+    :return: list of header dictionaries, see read_mrtrix_header
+    """
+    stored = {}
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, 'r') as handle:
+            stored = json.load(handle)
+        for path in stored:
+            _header_cache.setdefault(path, stored[path])
+
+    headers = []
+    for in_file in in_files:
+        path = os.path.abspath(in_file)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime]
+        entry = _header_cache.get(path)
+        if entry is None or entry['key'] != key:
+            entry = {'key': key, 'header': _parse_mrtrix_header(path, stat.st_size)}
+            _header_cache[path] = entry
+        headers.append(dict(entry['header']))
+
+    if cache_file:
+        changed = [path for path in _header_cache if stored.get(path) != _header_cache[path]]
+        if changed:
+            stored.update((path, _header_cache[path]) for path in changed)
+            with open(cache_file, 'w') as handle:
+                json.dump(stored, handle)
+    return headers
+
+
+def _parse_mrtrix_header(path, size):
+    with open(path, 'rb') as fileobj:
+        text = fileobj.read(4096)
+        while b'\nEND\n' not in text:
+            block = fileobj.read(4096)
+            if not block:
+                break
+            text += block
     header = {}
-    #iflogger.info("Reading header data...")
-    for line in fileobj:
-        line = line.decode()
-        if line == "END\n":
-            #iflogger.info("Reached the end of the header!")
-            break
-        elif ": " in line:
-            line = line.replace("\n", "")
-            line = line.replace("'", "")
-            key = line.split(": ")[0]
-            value = line.split(": ")[1]
-            header[key] = value
-            #iflogger.info('...adding "%s" to header for key "%s"', value, key)
-    fileobj.close()
-    header["count"] = int(header["count"].replace("\n", ""))
+    for line in text.split(b'\nEND\n')[0].decode().split('\n'):
+        if ": " in line:
+            key_value = line.replace("'", "").split(": ")
+            header[key_value[0]] = key_value[1]
+    header["count"] = int(header["count"])
     header["offset"] = int(header["file"].replace(".", ""))
+    header["size"] = size
+    dt = mrtrix_dtype(header)
+    header["triplets"] = (size - header["offset"]) // (np.dtype(dt).itemsize * 3) if dt else None
     return header
 
 
+def mrtrix_triplets(in_file, header):
+    """
+    Number of vertices (delimiters included) stored in a tck file
+    :param in_file: tck file path
+    :param header: tck header, see read_mrtrix_header
+    :return: number of x/y/z triplets after the header
+    """
+    if header.get("triplets") is not None:
+        return header["triplets"]
+    return (os.path.getsize(in_file) - header["offset"]) // (np.dtype(mrtrix_dtype(header)).itemsize * 3)
+
+
+def mrtrix_dtype(header):
+    """
+    Numpy dtype of the vertices of a tck file
+    :param header: tck header, see read_mrtrix_header
+    :return: dtype string, None if the datatype is not supported
+    """
+    datatype = header["datatype"]
+    if datatype.startswith('Float64'):
+        dt = 'f8'
+    elif datatype.startswith('Float32'):
+        dt = 'f4'
+    else:
+        return None
+    if datatype.endswith('LE'):
+        dt = '<' + dt
+    if datatype.endswith('BE'):
+        dt = '>' + dt
+    return dt
+
+
 def read_mrtrix_streamlines(in_file, header):
     byte_offset = header["offset"]
     stream_count = header["count"]
-    datatype = header["datatype"]
-    dt = 4
-    if datatype.startswith( 'Float64' ):
-        dt = 8
-    elif not datatype.startswith( 'Float32' ):
-        print('Unsupported datatype: ' + datatype)
+    dt = mrtrix_dtype(header)
+    if dt is None:
+        print('Unsupported datatype: ' + header["datatype"])
         return
     #tck format stores three floats (x/y/z) for each vertex
-    num_triplets = (os.path.getsize(in_file) - byte_offset) // (dt * 3)
-    dt = 'f' + str(dt)
-    if datatype.endswith( 'LE' ):
-        dt = '<'+dt
-    if datatype.endswith( 'BE' ):
-        dt = '>'+dt
+    num_triplets = mrtrix_triplets(in_file, header)
     vtx = np.fromfile(in_file, dtype=dt, count=(num_triplets*3), offset=byte_offset)
     vtx = np.reshape(vtx, (-1,3))
     #make sure last streamline delimited...
@@ -99,27 +175,300 @@ def read_mrtrix_streamlines(in_file, header):
     return vtx, line_starts, line_ends
 
 
-def save_vtk(filename, tracts, lines_indices=None):
-    lengths = [len(p) for p in tracts]
-    line_starts = ns.numpy.r_[0, ns.numpy.cumsum(lengths)]
-    if lines_indices is None:
-        lines_indices = [ns.numpy.arange(length) + line_start for length, line_start in zip(lengths, line_starts)]
+def read_mrtrix_streamlines_lazy(in_file, header, block_size=2 ** 20):
+    """
+    Memory-mapped tck streamlines, vertices are read from the disk only when a streamline is accessed
+    :param in_file: tck file path
+    :param header: tck header, see read_mrtrix_header
+    :param block_size: number of vertices scanned at once when looking for the streamlines delimiters
+    :return: Streamlines sequence backed by the file
+    """
+    dt = mrtrix_dtype(header)
+    if dt is None:
+        raise ValueError('Unsupported datatype: ' + header["datatype"])
+    num_triplets = mrtrix_triplets(in_file, header)
+    vtx = np.memmap(in_file, dtype=dt, mode='r', offset=header["offset"], shape=(num_triplets, 3))
+
+    delimiters = []
+    end = num_triplets
+    for start in range(0, num_triplets, block_size):
+        block = vtx[start:start + block_size]
+        stop, = np.where(np.isinf(block[:, 0]))
+        if stop.size:
+            end = start + stop[0]
+            block = block[:stop[0]]
+        nan_rows, = np.where(np.all(np.isnan(block), axis=1))
+        delimiters.append(nan_rows + start)
+        if stop.size:
+            break
+    line_ends = np.concatenate(delimiters) if delimiters else np.zeros(0, dtype=np.int64)
+    #a streamline interrupted by the end of the file is still returned
+    if end > (line_ends[-1] + 1 if line_ends.size else 0):
+        line_ends = np.append(line_ends, end)
+    line_starts = np.r_[0, line_ends[:-1] + 1][:line_ends.size]
 
-    ids = ns.numpy.hstack([ns.numpy.r_[c[0], c[1]] for c in zip(lengths, lines_indices)])
-    vtk_ids = ns.numpy_to_vtkIdTypeArray(ids.astype('int64'), deep=True)
+    if header["count"] != line_ends.size:
+        print('expected {} streamlines, found {}'.format(header["count"], line_ends.size))
 
-    cell_array = vtk.vtkCellArray()
-    cell_array.SetCells(len(tracts), vtk_ids)
-    points = ns.numpy.vstack(tracts).astype(ns.get_vtk_to_numpy_typemap()[vtk.VTK_DOUBLE])
-    points_array = ns.numpy_to_vtk(points, deep=True)
+    return Streamlines(vtx, line_starts, line_ends - line_starts)
 
-    poly_data = vtk.vtkPolyData()
-    vtk_points = vtk.vtkPoints()
-    vtk_points.SetData(points_array)
-    poly_data.SetPoints(vtk_points)
-    poly_data.SetLines(cell_array)
 
-    poly_data.BuildCells()
+def iter_tck(filename, chunk_size=50000):
+    header = read_mrtrix_header(filename)
+    return iter_mrtrix_streamlines(filename, header, chunk_size)
+
+
+def iter_mrtrix_streamlines(in_file, header, chunk_size=50000, block_size=2 ** 20):
+    """
+    Streamlines of a tck file read in batches, the memory used is bounded by the batch size
+    :param in_file: tck file path
+    :param header: tck header, see read_mrtrix_header
+    :param chunk_size: number of streamlines of every batch (the last one can be smaller)
+    :param block_size: number of vertices read from the disk at once
+    :return: generator of packed Streamlines batches
+    """
+    dt = mrtrix_dtype(header)
+    if dt is None:
+        raise ValueError('Unsupported datatype: ' + header["datatype"])
+    dt = np.dtype(dt)
+    native = dt.newbyteorder('=')
+
+    points, lengths = [], []
+    pending = 0
+    found = 0
+    tail = np.zeros((0, 3), dtype=native)
+    finished = False
+    with open(in_file, 'rb') as fileobj:
+        fileobj.seek(header["offset"])
+        while not finished:
+            block = np.fromfile(fileobj, dtype=dt, count=block_size * 3)
+            block = block[:block.size - block.size % 3].reshape(-1, 3).astype(native)
+            stop, = np.where(np.isinf(block[:, 0]))
+            if stop.size:
+                block = block[:stop[0]]
+                finished = True
+            elif len(block) < block_size:
+                finished = True
+            block = np.concatenate((tail, block))
+            #a streamline interrupted by the end of the file is still returned
+            if finished and len(block) and not np.isnan(block[-1, 0]):
+                block = np.concatenate((block, np.full((1, 3), np.nan, dtype=native)))
+
+            delimiter = np.all(np.isnan(block), axis=1)
+            line_ends, = np.where(delimiter)
+            cut = line_ends[-1] + 1 if line_ends.size else 0
+            tail = block[cut:]
+            if line_ends.size:
+                line_starts = np.r_[0, line_ends[:-1] + 1]
+                points.append(block[:cut][~delimiter[:cut]])
+                lengths.append(line_ends - line_starts)
+                pending += line_ends.size
+
+            while pending >= chunk_size or (finished and pending):
+                points = np.concatenate(points)
+                lengths = np.concatenate(lengths)
+                size = min(chunk_size, pending)
+                split = int(lengths[:size].sum())
+                yield Streamlines(points[:split], lengths_to_offsets(lengths[:size]), lengths[:size])
+                found += size
+                points, lengths = [points[split:]], [lengths[size:]]
+                pending -= size
+
+    if header["count"] != found:
+        print('expected {} streamlines, found {}'.format(header["count"], found))
+
+
+def save_tck(filename, streamlines, header=None):
+    with TckWriter(filename, header) as writer:
+        writer.write(streamlines)
+
+
+class TckWriter(object):
+    """
+    MRtrix tck writer, streamlines are written batch by batch and the final count is patched in the header on close
+    :param filename: tck output path
+    :param header: optional tck header (see read_mrtrix_header) whose additional fields are copied
+    :param append: add the streamlines to an existing tck file instead of overwriting it
+    """
+    count_width = 10
+
+    def __init__(self, filename, header=None, append=False):
+        self.filename = filename
+        if append and os.path.isfile(filename):
+            header = read_mrtrix_header(filename)
+            if mrtrix_dtype(header) != '<f4':
+                raise ValueError('Only Float32LE tck files can be extended: ' + header["datatype"])
+            self.count = header["count"]
+            self._fileobj = open(filename, 'r+b')
+            head = self._fileobj.read(header["offset"])
+            field = head.index(b'\ncount: ') + len(b'\ncount: ')
+            self._count_position = field
+            self.count_width = head.index(b'\n', field) - field
+            #new streamlines overwrite the end of file marker
+            size = os.path.getsize(filename)
+            end = header["offset"] + (size - header["offset"]) // 12 * 12
+            self._fileobj.seek(end - 12)
+            if not np.isinf(np.fromfile(self._fileobj, dtype='<f4', count=3)).any():
+                self._fileobj.seek(end)
+            else:
+                self._fileobj.seek(end - 12)
+        else:
+            self.count = 0
+            self._fileobj = open(filename, 'wb')
+            self._write_header(header or {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_header(self, header):
+        lines = ['mrtrix tracks']
+        for key, value in iteritems(header):
+            if key not in ('count', 'datatype', 'file', 'offset', 'size', 'triplets'):
+                lines.append('{}: {}'.format(key, value))
+        lines.append('datatype: Float32LE')
+        lines.append('count: ')
+        text = '\n'.join(lines)
+        self._count_position = len(text.encode())
+        text += '0' * self.count_width + '\n'
+        #the offset is part of the header it points past
+        offset = len(text.encode()) + len('file: . \nEND\n')
+        while offset != len(text.encode()) + len('file: . {}\nEND\n'.format(offset)):
+            offset = len(text.encode()) + len('file: . {}\nEND\n'.format(offset))
+        self._fileobj.write((text + 'file: . {}\nEND\n'.format(offset)).encode())
+
+    def write(self, streamlines):
+        """
+        Append a batch of streamlines
+        :param streamlines: Streamlines or list of (N, 3) arrays
+        """
+        streamlines = as_streamlines(streamlines).pack()
+        lengths = streamlines.lengths
+        if len(str(self.count + len(lengths))) > self.count_width:
+            raise ValueError('Too many streamlines for the count field of ' + self.filename)
+        vertices = np.full((streamlines.number_of_points + len(lengths), 3), np.nan, dtype='<f4')
+        vertices[np.arange(streamlines.number_of_points) + np.repeat(np.arange(len(lengths)), lengths)] = \
+            streamlines.points
+        vertices.tofile(self._fileobj)
+        self.count += len(lengths)
+
+    def close(self):
+        if self._fileobj.closed:
+            return
+        np.full(3, np.inf, dtype='<f4').tofile(self._fileobj)
+        self._fileobj.truncate()
+        self._fileobj.seek(self._count_position)
+        self._fileobj.write('{:0{}d}'.format(self.count, self.count_width).encode())
+        self._fileobj.close()
+
+
+def save_trx(filename, streamlines, point_data=None, cell_data=None, encoding='float16', step=0.01, compress=False):
+    """
+    Zip archive of raw arrays following the TRX layout (header.json, positions.3.float16, offsets.uint64 with a final
+    NB_VERTICES entry, dpv/ and dps/ folders). With the delta encoding the positions are replaced by the first point of every streamline
+    (starts.3.int32) and the differences between consecutive points (deltas.3.int16), in quantization steps
+    :param filename: output path (.trx)
+    :param streamlines: Streamlines or list of arrays
+    :param point_data: optional dictionary of per-point arrays (or Streamlines) in the packed order of the streamlines
+    :param cell_data: optional dictionary of per-streamline arrays
+    :param encoding: 'float16', 'float32' or 'delta'
+    :param step: quantization step (mm) of the delta encoding
+    :param compress: deflate the arrays, which can then no longer be memory-mapped
+    """
+    streamlines = as_streamlines(streamlines).pack()
+    offsets, lengths = streamlines.offsets, streamlines.lengths
+    header = {'NB_STREAMLINES': len(streamlines), 'NB_VERTICES': streamlines.number_of_points,
+              'VOXEL_TO_RASMM': np.eye(4).tolist(), 'DIMENSIONS': [1, 1, 1]}
+    arrays = [('offsets', np.r_[offsets, streamlines.number_of_points].astype(np.uint64))]
+    if encoding == 'delta':
+        quantized = np.rint(streamlines.points / step).astype(np.int64)
+        deltas = np.zeros_like(quantized)
+        deltas[1:] = np.diff(quantized, axis=0)
+        deltas[offsets[lengths > 0]] = 0
+        if len(deltas) and np.abs(deltas).max() > np.iinfo(np.int16).max:
+            raise ValueError('Segments too long for a quantization step of {} mm'.format(step))
+        starts = np.zeros((len(streamlines), 3), dtype=np.int32)
+        starts[lengths > 0] = quantized[offsets[lengths > 0]]
+        header['QUANTIZATION_STEP'] = step
+        arrays += [('starts', starts), ('deltas', deltas.astype(np.int16))]
+    elif encoding in ('float16', 'float32'):
+        arrays.append(('positions', streamlines.points.astype(encoding)))
+    else:
+        raise ValueError('Unknown encoding: ' + encoding)
+
+    for name, values in iteritems(point_data or {}):
+        if isinstance(values, Streamlines):
+            values = values.pack(values.points.dtype).points
+        arrays.append(('dpv/' + name, np.asarray(values)))
+    for name, values in iteritems(cell_data or {}):
+        arrays.append(('dps/' + name, np.asarray(values)))
+
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+                         allowZip64=True) as archive:
+        archive.writestr('header.json', json.dumps(header))
+        for name, values in arrays:
+            columns = '.{}'.format(values.shape[1]) if values.ndim == 2 and values.shape[1] > 1 else ''
+            values = values.astype(values.dtype.newbyteorder('<'))
+            archive.writestr(name + columns + '.' + values.dtype.name, np.ascontiguousarray(values).tobytes())
+
+
+def read_trx(filename, mmap=True):
+    """
+    Tractogram archive reading, see save_trx
+    :param filename: .trx path
+    :param mmap: memory-map the stored (not compressed) arrays instead of reading them
+    :return: Streamlines (float16 positions are not converted), dictionary of (N, C) point data Streamlines,
+    dictionary of cell data arrays
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as fileobj:
+        header = json.loads(archive.read('header.json').decode('utf-8'))
+        for info in archive.infolist():
+            if info.filename == 'header.json' or info.filename.endswith('/'):
+                continue
+            parts = info.filename.split('.')
+            dtype = np.dtype(parts[-1]).newbyteorder('<')
+            columns = int(parts[-2]) if len(parts) > 2 and parts[-2].isdigit() else 1
+            name = '.'.join(parts[:-2] if columns > 1 else parts[:-1])
+            if info.file_size == 0:
+                values = np.zeros(0, dtype=dtype)
+            elif mmap and info.compress_type == zipfile.ZIP_STORED:
+                #the data follows the local file header, whose name and extra field lengths can differ from the
+                #central directory ones
+                fileobj.seek(info.header_offset)
+                name_length, extra_length = struct.unpack('<HH', fileobj.read(30)[26:30])
+                values = np.memmap(filename, dtype, 'r', info.header_offset + 30 + name_length + extra_length,
+                                   info.file_size // dtype.itemsize)
+            else:
+                values = np.frombuffer(archive.read(info.filename), dtype)
+            arrays[name] = values.reshape(-1, columns) if columns > 1 else values
+
+    #older TRX files have no final NB_VERTICES offset
+    offsets = arrays['offsets'][:header['NB_STREAMLINES']].astype(np.int64)
+    lengths = np.diff(np.r_[offsets, header['NB_VERTICES']])
+    if 'positions' in arrays:
+        points = arrays['positions']
+    else:
+        #cumulated deltas, shifted streamline by streamline on their first point
+        cumulated = np.cumsum(arrays['deltas'], axis=0, dtype=np.int64)
+        filled = lengths > 0
+        shifts = cumulated[offsets[filled]] - arrays['starts'][filled]
+        points = ((cumulated - np.repeat(shifts, lengths[filled], axis=0)) * header['QUANTIZATION_STEP']).astype(
+            np.float32)
+
+    point_data, cell_data = {}, {}
+    for name, values in iteritems(arrays):
+        if name.startswith('dpv/'):
+            point_data[name[4:]] = Streamlines(values.reshape(len(values), -1), offsets, lengths)
+        elif name.startswith('dps/'):
+            cell_data[name[4:]] = values
+    return Streamlines(points, offsets, lengths), point_data, cell_data
+
+
+def save_vtk(filename, tracts, lines_indices=None, point_data=None, cell_data=None):
+    poly_data = tracts_to_vtkpolydata(tracts, lines_indices, point_data, cell_data)
 
     if filename.endswith('.xml') or filename.endswith('.vtp'):
         writer = vtk.vtkXMLPolyDataWriter()
@@ -136,8 +485,176 @@ def save_vtk(filename, tracts, lines_indices=None):
     writer.Write()
 
 
-def save_nii(fname, data, affine):
-    img = nib.Nifti1Image(data.astype(np.int16), affine)
+def tracts_to_vtkpolydata(tracts, lines_indices=None, point_data=None, cell_data=None):
+    """
+    VTK polylines creation
+    :param tracts: Streamlines or list of arrays
+    :param lines_indices: optional point ids of every polyline
+    :param point_data: optional dictionary of per-point arrays (or Streamlines) in the packed order of the tracts
+    :param cell_data: optional dictionary of per-streamline arrays
+    :return: vtkPolyData
+    """
+    if not isinstance(tracts, Streamlines) and len(tracts):
+        #lists keep their dtype, as_streamlines would convert them to float32
+        tracts = as_streamlines(tracts, np.result_type(*set(np.asarray(t).dtype for t in tracts)))
+    tracts = as_streamlines(tracts)
+    lengths = tracts.lengths
+    if lines_indices is None:
+        connectivity = np.arange(tracts.number_of_points, dtype=np.int64)
+    else:
+        connectivity = np.concatenate([np.asarray(i, dtype=np.int64) for i in lines_indices])
+
+    cell_array = vtk.vtkCellArray()
+    if hasattr(cell_array, 'GetOffsetsArray'):
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        cell_array.SetData(ns.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                           ns.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+    else:
+        ids = legacy_cells(lengths, connectivity=connectivity)
+        cell_array.SetCells(len(tracts), ns.numpy_to_vtkIdTypeArray(ids, deep=True))
+
+    #float32 tractograms (tck, Slicer fiber bundles) are not promoted to double
+    dtype = np.float32 if tracts.points.dtype.itemsize == 4 else np.float64
+    points = tracts.pack(dtype).points
+    points_array = ns.numpy_to_vtk(points, deep=True)
+
+    poly_data = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(points_array)
+    poly_data.SetPoints(vtk_points)
+    poly_data.SetLines(cell_array)
+
+    for name, values in iteritems(point_data or {}):
+        if isinstance(values, Streamlines):
+            values = values.pack(values.points.dtype).points
+        values = np.ascontiguousarray(values)
+        if values.ndim == 2 and values.shape[1] == 1:
+            values = values[:, 0]
+        array = ns.numpy_to_vtk(values, deep=True)
+        array.SetName(name)
+        poly_data.GetPointData().AddArray(array)
+        if poly_data.GetPointData().GetScalars() is None and values.ndim == 1:
+            poly_data.GetPointData().SetActiveScalars(name)
+
+    for name, values in iteritems(cell_data or {}):
+        array = ns.numpy_to_vtk(np.ascontiguousarray(values), deep=True)
+        array.SetName(name)
+        poly_data.GetCellData().AddArray(array)
+
+    poly_data.BuildCells()
+    return poly_data
+
+
+#numpy dtype of vtkIdType, the cell arrays can only be shared without copy in it
+VTK_ID_DTYPE = np.dtype(ns.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE])
+
+
+class PolyDataBuffer(object):
+    """
+    vtkPolyData of a tractogram growing batch by batch: the points and cells are stored in numpy buffers shared
+    with VTK without copy, appending a batch only copies its own streamlines (the buffers double when full)
+    :param n_points: initial points capacity
+    :param n_lines: initial streamlines capacity
+    """
+
+    def __init__(self, n_points=2 ** 20, n_lines=2 ** 14):
+        self.points = np.empty((max(n_points, 1), 3), dtype=np.float32)
+        self.offsets = np.zeros(max(n_lines, 1) + 1, dtype=VTK_ID_DTYPE)
+        self.connectivity = np.arange(max(n_points, 1), dtype=VTK_ID_DTYPE)
+        self.n_points = 0
+        self.n_lines = 0
+        self.polydata = vtk.vtkPolyData()
+
+    def __len__(self):
+        return self.n_lines
+
+    def append(self, streamlines):
+        """
+        :param streamlines: Streamlines or list of arrays
+        :return: the updated vtkPolyData
+        """
+        streamlines = as_streamlines(streamlines).pack()
+        n_points = self.n_points + streamlines.number_of_points
+        n_lines = self.n_lines + len(streamlines)
+        if n_points > len(self.points):
+            capacity = max(n_points, 2 * len(self.points))
+            self.points = np.concatenate((self.points[:self.n_points],
+                                          np.empty((capacity - self.n_points, 3), dtype=np.float32)))
+            self.connectivity = np.arange(capacity, dtype=VTK_ID_DTYPE)
+        if n_lines >= len(self.offsets):
+            self.offsets = np.concatenate((self.offsets[:self.n_lines + 1],
+                                           np.zeros(max(n_lines + 1, 2 * len(self.offsets)) - self.n_lines - 1,
+                                                    dtype=VTK_ID_DTYPE)))
+        self.points[self.n_points:n_points] = streamlines.points
+        self.offsets[self.n_lines + 1:n_lines + 1] = self.n_points + np.cumsum(streamlines.lengths)
+        self.n_points, self.n_lines = n_points, n_lines
+
+        #views on the buffers, numpy_to_vtk keeps a reference to them
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(ns.numpy_to_vtk(self.points[:n_points], deep=False))
+        cell_array = vtk.vtkCellArray()
+        if hasattr(cell_array, 'GetOffsetsArray'):
+            cell_array.SetData(ns.numpy_to_vtkIdTypeArray(self.offsets[:n_lines + 1], deep=False),
+                               ns.numpy_to_vtkIdTypeArray(self.connectivity[:n_points], deep=False))
+        else:
+            ids = legacy_cells(np.diff(self.offsets[:n_lines + 1]))
+            cell_array.SetCells(n_lines, ns.numpy_to_vtkIdTypeArray(ids, deep=True))
+        self.polydata.SetPoints(vtk_points)
+        self.polydata.SetLines(cell_array)
+        self.polydata.Modified()
+        return self.polydata
+
+
+def save_vtk_streamed(filename, streamlines, chunk_size=50000):
+    """
+    Legacy binary VTK writer working chunk by chunk, no VTK object is built in memory
+    :param filename: .vtk output path
+    :param streamlines: Streamlines, e.g. memory-mapped from a tck file
+    :param chunk_size: number of streamlines converted at once
+    """
+    lengths = streamlines.lengths
+    n_points = streamlines.number_of_points
+    with open(filename, 'wb') as fileobj:
+        fileobj.write('# vtk DataFile Version 3.0\nvtk output\nBINARY\nDATASET POLYDATA\nPOINTS {} float\n'.format(
+            n_points).encode())
+        for start in range(0, len(streamlines), chunk_size):
+            streamlines[start:start + chunk_size].pack().points.astype('>f4').tofile(fileobj)
+        fileobj.write('\nLINES {} {}\n'.format(len(streamlines), len(streamlines) + n_points).encode())
+        first_id = 0
+        for start in range(0, len(streamlines), chunk_size):
+            chunk_lengths = lengths[start:start + chunk_size]
+            legacy_cells(chunk_lengths, first_id).astype('>i4').tofile(fileobj)
+            first_id += int(chunk_lengths.sum())
+        fileobj.write(b'\n')
+
+
+def legacy_cells(lengths, first_id=0, connectivity=None):
+    """
+    VTK legacy cell array, [n_0, ids_0..., n_1, ids_1...], of consecutive polylines
+    :param lengths: number of points of every polyline
+    :param first_id: id of the first point of the first polyline
+    :param connectivity: point ids of all the polylines, consecutive ids from first_id by default
+    :return: int64 cell array
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    heads = lengths_to_offsets(lengths) + np.arange(len(lengths))
+    cells = np.empty(len(lengths) + int(lengths.sum()), dtype=np.int64)
+    is_id = np.ones(len(cells), dtype=bool)
+    is_id[heads] = False
+    cells[heads] = lengths
+    if connectivity is None:
+        connectivity = np.arange(first_id, first_id + len(cells) - len(lengths))
+    cells[is_id] = connectivity
+    return cells
+
+
+def read_nii(fname):
+    img = nib.load(fname)
+    return img.get_fdata(dtype=np.float32), img.affine
+
+
+def save_nii(fname, data, affine, dtype=np.int16):
+    img = nib.Nifti1Image(data.astype(dtype), affine)
     nib.save(img, fname)
 
 
@@ -147,8 +664,13 @@ def vtkpolydata_to_tracts(polydata):
     :param polydata: vtk file polydata
     :return: tractogram, associated data
     """
-    result = {'lines': ns.vtk_to_numpy(polydata.GetLines().GetData()),
-              'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    result = {'points': ns.vtk_to_numpy(polydata.GetPoints().GetData()), 'numberOfLines': polydata.GetNumberOfLines()}
+    cell_array = polydata.GetLines()
+    if hasattr(cell_array, 'GetOffsetsArray'):
+        result['offsets'] = ns.vtk_to_numpy(cell_array.GetOffsetsArray())
+        result['connectivity'] = ns.vtk_to_numpy(cell_array.GetConnectivityArray())
+    else:
+        result['lines'] = ns.vtk_to_numpy(cell_array.GetData())
 
     data = {}
     if polydata.GetPointData().GetScalars():
@@ -174,37 +696,49 @@ def vtkpolydata_to_tracts(polydata):
 def vtkpolydata_dictionary_to_tracts_and_data(dictionary):
     """
     VTK polydata management
-    :param dictionary: polydata dictionary
+    :param dictionary: polydata dictionary, polylines given either as VTK 9 offsets and connectivity or as legacy lines
     :return: tractogram, associated data
     """
-    dictionary_keys = {'lines', 'points', 'numberOfLines'}
-    if not dictionary_keys.issubset(dictionary):
-        raise ValueError("Dictionary must have the keys lines and points" + repr(dictionary))
+    dictionary_keys = {'points', 'numberOfLines'}
+    if not dictionary_keys.issubset(dictionary) or not (
+            'lines' in dictionary or {'offsets', 'connectivity'}.issubset(dictionary)):
+        raise ValueError("Dictionary must have the keys lines (or offsets and connectivity) and points" + repr(
+            dictionary))
 
     tract_data = {}
-    tracts = []
-
-    lines = np.asarray(dictionary['lines']).squeeze()
     points = dictionary['points']
-
-    actual_line_index = 0
     number_of_tracts = dictionary['numberOfLines']
-    original_lines = []
-    for _ in range(number_of_tracts):
-        tracts.append(points[lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1]])
-        original_lines.append(
-            np.array(lines[actual_line_index + 1:actual_line_index + lines[actual_line_index] + 1], copy=True))
-        actual_line_index += lines[actual_line_index] + 1
 
-    if 'pointData' in dictionary:
-        point_data_keys = [it[0] for it in iteritems(dictionary['pointData']) if isinstance(it[1], np.ndarray)]
+    if 'connectivity' in dictionary:
+        connectivity = np.asarray(dictionary['connectivity']).squeeze()
+        bounds = np.asarray(dictionary['offsets'], dtype=np.int64).squeeze()
+        offsets = bounds[:number_of_tracts]
+        lengths = np.diff(bounds)[:number_of_tracts]
+    else:
+        lines = np.asarray(dictionary['lines']).squeeze()
+        #the position of each line header depends on the previous one, only the headers are visited
+        heads = np.empty(number_of_tracts, dtype=np.int64)
+        position = 0
+        for i in range(number_of_tracts):
+            heads[i] = position
+            position += int(lines[position]) + 1
+        lengths = lines[heads].astype(np.int64)
+        offsets = heads - np.arange(number_of_tracts)
+        is_id = np.ones(position, dtype=bool)
+        is_id[heads] = False
+        connectivity = lines[:position][is_id]
+
+    #polylines written one after the other are returned as views on the original buffers
+    sequential = connectivity.size <= len(points) and np.array_equal(connectivity, np.arange(connectivity.size))
+
+    def pack(array):
+        return array[:connectivity.size] if sequential else array[connectivity]
+
+    tracts = Streamlines(pack(points), offsets, lengths)
 
-        for k in point_data_keys:
-            array_data = dictionary['pointData'][k]
-            if k not in tract_data:
-                tract_data[k] = [array_data[f] for f in original_lines]
-            else:
-                np.vstack(tract_data[k])
-                tract_data[k].extend([array_data[f] for f in original_lines[-number_of_tracts:]])
+    if 'pointData' in dictionary:
+        for k, array_data in iteritems(dictionary['pointData']):
+            if isinstance(array_data, np.ndarray):
+                tract_data[k] = Streamlines(pack(array_data), offsets, lengths)
 
     return tracts, tract_data
@@ -1,11 +1,94 @@
 import numpy as np
-from .input_output import save_vtk, read_vtk
-from dipy.tracking.metrics import mean_orientation
+from .input_output import save_vtk, read_vtk, read_mrtrix_header, iter_mrtrix_streamlines, TckWriter, \
+    tracts_to_vtkpolydata
+from .streamlines import Streamlines
+from .metrics import principal_directions, direction_classes
+from .clustering import quickbundles, split_by_labels, unique_streamlines
 
 
 def filter(in_fpath, out_fpath, dir):
-    fibers = np.array(read_vtk(in_fpath)[0])
-    mean_or = [mean_orientation(f) for f in fibers]
-    princ = np.array([abs(x).argmax() for x in mean_or])
+    fibers = read_vtk(in_fpath)[0]
+    princ = principal_directions(fibers)
     seg = fibers[princ == dir]
     save_vtk(out_fpath, seg)
+
+
+def split_directions(in_fpath, out_fpaths, oblique=None):
+    """
+    Principal direction filter writing every direction bundle from a single classification
+    :param in_fpath: input vtk tractogram
+    :param out_fpaths: ML, AP and SI output paths, plus the oblique one when oblique is given
+    :param oblique: minimum cosine between a fiber mean orientation and its principal axis, see direction_classes
+    """
+    fibers = read_vtk(in_fpath)[0]
+    classes = direction_classes(fibers, oblique)
+    for dir, out_fpath in enumerate(out_fpaths):
+        save_vtk(out_fpath, fibers[classes == dir])
+
+
+def split_directions_tck(in_fpath, out_fpaths, oblique=None, chunk_size=50000):
+    """
+    Principal direction filter of a tck file, read and written chunk by chunk so the memory used does not depend on
+    the size of the tractogram
+    :param in_fpath: input tck tractogram
+    :param out_fpaths: ML, AP and SI output tck paths, plus the oblique one when oblique is given. None skips a class
+    :param oblique: minimum cosine between a fiber mean orientation and its principal axis, see direction_classes
+    :param chunk_size: number of streamlines classified at once
+    """
+    header = read_mrtrix_header(in_fpath)
+    writers = [TckWriter(out_fpath, header) if out_fpath else None for out_fpath in out_fpaths]
+    try:
+        for chunk in iter_mrtrix_streamlines(in_fpath, header, chunk_size):
+            classes = direction_classes(chunk, oblique)
+            for dir, writer in enumerate(writers):
+                if writer is not None:
+                    writer.write(chunk[classes == dir])
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+
+
+def split_clusters(in_fpath, out_fpath_format, threshold=10., min_size=1):
+    """
+    QuickBundles clustering of a vtk tractogram, every bundle is written in its own file, largest first
+    :param in_fpath: input vtk tractogram
+    :param out_fpath_format: output path with a {} field for the bundle rank, e.g. 'cluster_{}.vtk'
+    :param threshold: maximum MDF distance (mm) between a fiber and the centroid of its bundle, see quickbundles
+    :param min_size: smallest number of fibers of a written bundle
+    :return: output paths
+    """
+    fibers = read_vtk(in_fpath)[0]
+    labels, _ = quickbundles(fibers, threshold)
+    out_fpaths = []
+    for rank, bundle in enumerate(split_by_labels(fibers, labels, min_size)):
+        out_fpaths.append(out_fpath_format.format(rank))
+        save_vtk(out_fpaths[-1], bundle)
+    return out_fpaths
+
+
+def deduplicate(in_fpath, out_fpath, tolerance=0.5, multiplicity=True):
+    """
+    Duplicate and near-duplicate removal, see unique_streamlines
+    :param in_fpath: input vtk tractogram
+    :param out_fpath: output vtk tractogram
+    :param tolerance: maximum MDF distance (mm) between two duplicates
+    :param multiplicity: write the number of collapsed fibers of every kept fiber as 'multiplicity' cell data
+    :return: number of kept fibers
+    """
+    fibers = read_vtk(in_fpath)[0]
+    kept, counts = unique_streamlines(fibers, tolerance)
+    save_vtk(out_fpath, fibers[kept], cell_data={'multiplicity': counts.astype(np.int32)} if multiplicity else None)
+    return len(kept)
+
+
+def subset_polydata(fibers, data, selection):
+    """
+    vtkPolyData of a subset of a tractogram, without any file round trip
+    :param fibers: Streamlines, see vtkpolydata_to_tracts
+    :param data: point data dictionary of the tractogram, see vtkpolydata_to_tracts
+    :param selection: boolean mask or indices of the kept fibers
+    :return: vtkPolyData with the point data arrays of the kept fibers
+    """
+    point_data = {name: values[selection] for name, values in data.items() if isinstance(values, Streamlines)}
+    return tracts_to_vtkpolydata(fibers[selection], point_data=point_data)
@@ -0,0 +1,191 @@
+import numpy as np
+from .streamlines import Streamlines, as_streamlines, lengths_to_offsets
+
+
+DIRECTION_NAMES = ['ML', 'AP', 'SI', 'oblique']
+
+
+def mean_orientations(streamlines):
+    """
+    Mean orientation of every streamline, same values as dipy.tracking.metrics.mean_orientation. The sum of the
+    point-wise gradient telescopes, so only the first two and the last two points of each streamline are read
+    :param streamlines: Streamlines or list of arrays
+    :return: (N, 3) mean orientations, zero for the empty streamlines
+    """
+    streamlines = as_streamlines(streamlines)
+    orientations = np.zeros((len(streamlines), 3))
+    nonempty = streamlines.lengths > 0
+    streamlines = streamlines[nonempty]
+    points = streamlines.points
+    first = streamlines.offsets
+    last = first + streamlines.lengths - 1
+    second = np.minimum(first + 1, last)
+    before_last = np.maximum(last - 1, first)
+
+    total = 1.5 * (points[last].astype(np.float64) - points[first]) + \
+        0.5 * (points[second].astype(np.float64) - points[before_last])
+    orientations[nonempty] = total / streamlines.lengths[:, None]
+    return orientations
+
+
+def principal_directions(streamlines):
+    """
+    Principal direction of every streamline
+    :param streamlines: Streamlines or list of arrays
+    :return: axis of the largest mean orientation component (0: ML, 1: AP, 2: SI)
+    """
+    return np.abs(mean_orientations(streamlines)).argmax(axis=1)
+
+
+def direction_classes(streamlines, oblique=None):
+    """
+    Principal direction of every streamline, with an optional class for the fibers far from every axis
+    :param streamlines: Streamlines or list of arrays
+    :param oblique: minimum cosine between the mean orientation and its principal axis, class 3 below it
+    :return: 0: ML, 1: AP, 2: SI, 3: oblique
+    """
+    orientations = np.abs(mean_orientations(streamlines))
+    classes = orientations.argmax(axis=1)
+    if oblique is not None:
+        norms = np.linalg.norm(orientations, axis=1)
+        principal = orientations[np.arange(len(classes)), classes]
+        classes[principal < oblique * norms] = 3
+    return classes
+
+
+def _segments(streamlines):
+    """
+    Segment vectors of packed streamlines, the segments joining two consecutive streamlines are zero
+    :param streamlines: packed Streamlines
+    :return: (N - 1, 3) float64 segment vectors
+    """
+    segments = np.diff(streamlines.points.astype(np.float64), axis=0)
+    joints = streamlines.offsets[1:] - 1
+    #the empty streamlines at both ends of the buffer have no joint
+    segments[joints[(joints >= 0) & (joints < len(segments))]] = 0
+    return segments
+
+
+def _arc_lengths(streamlines):
+    """
+    Cumulative arc length along the packed points buffer, restarting nowhere: the length of a streamline is the
+    difference between its last and first entries
+    :param streamlines: packed Streamlines
+    :return: (N,) float64 cumulative arc length
+    """
+    arc = np.zeros(streamlines.number_of_points)
+    np.cumsum(np.linalg.norm(_segments(streamlines), axis=1), out=arc[1:])
+    return arc
+
+
+def streamline_lengths(streamlines):
+    """
+    Length of every streamline
+    :param streamlines: Streamlines or list of arrays
+    :return: (N,) lengths in the points units (mm), zero for the empty streamlines
+    """
+    streamlines = as_streamlines(streamlines).pack()
+    lengths = np.zeros(len(streamlines))
+    nonempty = streamlines.lengths > 0
+    if not nonempty.any():
+        return lengths
+    arc = _arc_lengths(streamlines)
+    first = streamlines.offsets[nonempty]
+    lengths[nonempty] = arc[first + streamlines.lengths[nonempty] - 1] - arc[first]
+    return lengths
+
+
+def mean_curvatures(streamlines):
+    """
+    Mean curvature of every streamline, total turning angle divided by the length
+    :param streamlines: Streamlines or list of arrays
+    :return: (N,) mean curvatures in radians per points unit (mm), zero for the streamlines shorter than two points
+    """
+    streamlines = as_streamlines(streamlines).pack()
+    curvatures = np.zeros(len(streamlines))
+    nonempty = streamlines.lengths > 0
+    if not nonempty.any():
+        return curvatures
+    segments = _segments(streamlines)
+    norms = np.linalg.norm(segments, axis=1)
+    units = segments / np.maximum(norms, 1e-12)[:, None]
+    #turning angle at every interior vertex, zero where one of the segments is a joint
+    cosines = np.clip(np.einsum('ij,ij->i', units[:-1], units[1:]), -1., 1.)
+    angles = np.where((norms[:-1] > 0) & (norms[1:] > 0), np.arccos(cosines), 0.)
+    turning = np.zeros(streamlines.number_of_points)
+    np.cumsum(angles, out=turning[2:])
+    arc = np.zeros(streamlines.number_of_points)
+    np.cumsum(norms, out=arc[1:])
+    first = streamlines.offsets[nonempty]
+    last = first + streamlines.lengths[nonempty] - 1
+    #the last vertex of a streamline is not a turning point
+    total = turning[last] - turning[np.minimum(first + 1, last)]
+    length = arc[last] - arc[first]
+    curvatures[nonempty] = np.where(length > 0, total / np.maximum(length, 1e-12), 0.)
+    return curvatures
+
+
+def resample(streamlines, n_points=None, step=None, out=None, chunk_size=50000):
+    """
+    Streamlines resampled with points equally spaced along their arc length, either a fixed number of points or a
+    fixed maximum step (the endpoints are kept, so the step is shortened to split each streamline evenly). The empty
+    streamlines stay empty with a step and get NaN points with a number of points
+    :param streamlines: Streamlines or list of arrays
+    :param n_points: number of points of every output streamline
+    :param step: maximum distance between two output points
+    :param out: preallocated (total points, 3) float32 buffer the resampled points are written to
+    :param chunk_size: number of streamlines resampled at once
+    :return: packed Streamlines, backed by out when given
+    """
+    if (n_points is None) == (step is None):
+        raise ValueError('Either n_points or step must be given')
+    streamlines = as_streamlines(streamlines)
+    count = len(streamlines)
+    if n_points is not None:
+        out_lengths = np.full(count, n_points, dtype=np.int64)
+    else:
+        arc_lengths = np.concatenate([np.zeros(0)] + [streamline_lengths(streamlines[start:start + chunk_size])
+                                                      for start in range(0, count, chunk_size)])
+        out_lengths = np.maximum(np.ceil(arc_lengths / step), 1).astype(np.int64) + 1
+        out_lengths[streamlines.lengths == 0] = 0
+    out_offsets = lengths_to_offsets(out_lengths)
+    total = int(out_lengths.sum())
+    if out is None:
+        out = np.empty((total, 3), dtype=np.float32)
+    elif out.shape != (total, 3):
+        raise ValueError('Output buffer shape must be {}'.format((total, 3)))
+
+    for start in range(0, count, chunk_size):
+        chunk = streamlines[start:start + chunk_size].pack()
+        lengths = out_lengths[start:start + chunk_size]
+        first_out = out_offsets[start]
+        _resample_into(chunk, lengths, out[first_out:first_out + int(lengths.sum())])
+    return Streamlines(out, out_offsets, out_lengths)
+
+
+def _resample_into(streamlines, out_lengths, out):
+    nonempty = streamlines.lengths > 0
+    if not nonempty.all():
+        valid = np.repeat(nonempty, out_lengths)
+        out[~valid] = np.nan
+        points = np.empty((int(valid.sum()), 3), dtype=out.dtype)
+        if len(points):
+            _resample_into(streamlines[nonempty].pack(), out_lengths[nonempty], points)
+        out[valid] = points
+        return
+
+    arc = _arc_lengths(streamlines)
+    first = np.repeat(streamlines.offsets, out_lengths)
+    last = np.repeat(streamlines.offsets + streamlines.lengths - 1, out_lengths)
+    ranks = np.arange(len(out)) - np.repeat(lengths_to_offsets(out_lengths), out_lengths)
+    fractions = ranks / np.repeat(np.maximum(out_lengths - 1, 1), out_lengths).astype(np.float64)
+    targets = arc[first] + fractions * (arc[last] - arc[first])
+
+    #one search on the whole buffer, clipped to the segments of each streamline
+    after = np.clip(np.searchsorted(arc, targets, side='right'), first + 1, last)
+    before = np.where(last > first, after - 1, after)
+    span = arc[after] - arc[before]
+    weights = np.where(span > 0, (targets - arc[before]) / np.where(span > 0, span, 1.), 0.)[:, None]
+    points = streamlines.points
+    out[:] = points[before]
+    out += (weights * (points[after] - points[before])).astype(out.dtype)
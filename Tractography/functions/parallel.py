@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from joblib import Parallel, delayed, cpu_count, dump, load
+from .streamlines import Streamlines, as_streamlines, concatenate_streamlines
+from .metrics import mean_orientations, streamline_lengths, mean_curvatures, resample
+
+
+KERNELS = {'orientation': mean_orientations, 'length': streamline_lengths, 'curvature': mean_curvatures,
+           'resample': resample}
+
+
+def map_streamlines(kernel, streamlines, n_jobs=None, shard_size=None, **kwargs):
+    """
+    Per-streamline kernel applied on shards of a tractogram by joblib workers. The points are shared with the workers
+    as a memmap, the one of the tck file or a copy dumped once in a temporary folder, only the offsets and lengths of
+    each shard are sent to them
+    :param kernel: name in KERNELS or module level function taking Streamlines (and kwargs)
+    :param streamlines: Streamlines (e.g. memory-mapped from a tck file) or list of arrays
+    :param n_jobs: number of processes, all the cores by default
+    :param shard_size: number of streamlines of every shard, four shards per process by default
+    :return: kernel results of all the shards, in order
+    """
+    streamlines = as_streamlines(streamlines)
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    if shard_size is None:
+        shard_size = max(1, -(-len(streamlines) // (4 * n_jobs)))
+    function = KERNELS.get(kernel, kernel)
+    if n_jobs == 1 or len(streamlines) <= shard_size:
+        return function(streamlines, **kwargs)
+
+    tmp = None
+    points = streamlines.points
+    try:
+        if not isinstance(points, np.memmap):
+            tmp = tempfile.mkdtemp()
+            path = os.path.join(tmp, 'points.pkl')
+            dump(points, path)
+            points = load(path, mmap_mode='r')
+        offsets, lengths = streamlines.offsets, streamlines.lengths
+        bounds = range(0, len(streamlines), shard_size)
+        results = Parallel(n_jobs=n_jobs)(delayed(_run_shard)(function, points, offsets[start:start + shard_size],
+                                                              lengths[start:start + shard_size], kwargs)
+                                          for start in bounds)
+    finally:
+        del points
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if isinstance(results[0], Streamlines):
+        return concatenate_streamlines(results)
+    return np.concatenate(results)
+
+
+def _run_shard(function, points, offsets, lengths, kwargs):
+    result = function(Streamlines(points, offsets, lengths), **kwargs)
+    if isinstance(result, Streamlines):
+        return result.pack()
+    return np.asarray(result)
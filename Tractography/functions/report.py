@@ -0,0 +1,89 @@
+import json
+import numpy as np
+from .streamlines import iter_batches
+from .metrics import DIRECTION_NAMES, direction_classes, streamline_lengths
+from .input_output import read_mrtrix_header, iter_mrtrix_streamlines
+
+
+def tractogram_report(streamlines, bins=10., max_length=800., oblique=None, chunk_size=50000):
+    """
+    Quality control statistics of a tractogram computed in a single pass, batch by batch
+    :param streamlines: Streamlines, list of arrays or iterable of Streamlines batches (e.g. iter_tck)
+    :param bins: width (mm) of the length histogram bins
+    :param max_length: upper edge of the length histogram, longer streamlines are counted in the last bin
+    :param oblique: minimum cosine for the direction classes, see direction_classes
+    :param chunk_size: number of streamlines processed at once
+    :return: JSON serializable dictionary
+    """
+    edges = np.arange(0., max_length + bins, bins)
+    histogram = np.zeros(len(edges) - 1, dtype=np.int64)
+    names = DIRECTION_NAMES if oblique is not None else DIRECTION_NAMES[:3]
+    class_counts = np.zeros(len(names), dtype=np.int64)
+    class_lengths = np.zeros(len(names))
+    #exact points per streamline distribution, indexed by the number of points
+    points_counts = np.zeros(0, dtype=np.int64)
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    count = 0
+    total_length = 0.
+    shortest, longest = np.inf, 0.
+
+    for chunk in iter_batches(streamlines, chunk_size):
+        chunk = chunk.pack()
+        if not len(chunk):
+            continue
+        count += len(chunk)
+        lengths = streamline_lengths(chunk)
+        histogram += np.bincount(np.minimum((lengths // bins).astype(np.int64), len(histogram) - 1),
+                                 minlength=len(histogram))
+        total_length += lengths.sum()
+        shortest, longest = min(shortest, lengths.min()), max(longest, lengths.max())
+
+        classes = direction_classes(chunk, oblique)
+        class_counts += np.bincount(classes, minlength=len(names))
+        class_lengths += np.bincount(classes, lengths, minlength=len(names))
+
+        counts = np.bincount(chunk.lengths)
+        if len(counts) > len(points_counts):
+            points_counts = np.r_[points_counts, np.zeros(len(counts) - len(points_counts), dtype=np.int64)]
+        points_counts[:len(counts)] += counts
+
+        if len(chunk.points):
+            lower = np.minimum(lower, chunk.points.min(axis=0))
+            upper = np.maximum(upper, chunk.points.max(axis=0))
+
+    report = {'count': count, 'points': int(np.dot(points_counts, np.arange(len(points_counts))))}
+    report['length'] = {'mean': float(total_length / count) if count else None,
+                        'min': float(shortest) if count else None,
+                        'max': float(longest) if count else None,
+                        'histogram': {'edges': edges.tolist(), 'counts': histogram.tolist()}}
+    report['directions'] = {name: {'count': int(n), 'mean_length': float(length / n) if n else None}
+                            for name, n, length in zip(names, class_counts, class_lengths)}
+    report['bounding_box'] = {'min': lower.tolist(), 'max': upper.tolist()} if report['points'] else None
+
+    cumulated = np.cumsum(points_counts)
+    report['points_per_streamline'] = {
+        'mean': report['points'] / float(count) if count else None,
+        'min': int(np.flatnonzero(points_counts)[0]) if count else None,
+        'max': len(points_counts) - 1 if count else None,
+        'percentiles': {str(q): int(np.searchsorted(cumulated, q / 100. * count)) if count else None
+                        for q in (5, 25, 50, 75, 95)}}
+    return report
+
+
+def tck_report(in_fpath, out_fpath=None, chunk_size=50000, **kwargs):
+    """
+    Statistics of a tck file streamed from the disk, see tractogram_report
+    :param in_fpath: tck tractogram
+    :param out_fpath: optional JSON output path
+    :param chunk_size: number of streamlines read at once
+    :return: report dictionary, with the tck header count for comparison
+    """
+    header = read_mrtrix_header(in_fpath)
+    report = tractogram_report(iter_mrtrix_streamlines(in_fpath, header, chunk_size), chunk_size=chunk_size,
+                               **kwargs)
+    report['header_count'] = header['count']
+    if out_fpath is not None:
+        with open(out_fpath, 'w') as fileobj:
+            json.dump(report, fileobj, indent=2)
+    return report
@@ -0,0 +1,200 @@
+import numpy as np
+from scipy.ndimage import map_coordinates
+from .streamlines import as_streamlines
+
+
+def apply_affine(affine, points):
+    """
+    4x4 affine applied on an array of points
+    :param affine: (4, 4) matrix
+    :param points: (N, 3) array
+    :return: (N, 3) float64 transformed points
+    """
+    affine = np.asarray(affine, dtype=np.float64)
+    return np.dot(points, affine[:3, :3].T) + affine[:3, 3]
+
+
+def voxel_size(affine):
+    """
+    Voxel spacing of an image from its voxel to world affine
+    :param affine: (4, 4) voxel to world (RAS mm) matrix
+    :return: (3,) spacing
+    """
+    return np.linalg.norm(np.asarray(affine)[:3, :3], axis=0)
+
+
+def voxel_indices(points, affine, shape=None):
+    """
+    Nearest voxel of world points
+    :param points: (N, 3) world coordinates (RAS mm)
+    :param affine: (4, 4) voxel to world matrix of the image
+    :param shape: image shape, when given the points outside the image are flagged
+    :return: (N, 3) int64 voxel indices, (N,) inside mask if shape is given
+    """
+    ijk = np.rint(apply_affine(np.linalg.inv(affine), points)).astype(np.int64)
+    if shape is None:
+        return ijk
+    inside = np.all((ijk >= 0) & (ijk < np.asarray(shape[:3])), axis=1)
+    return ijk, inside
+
+
+def lookup(volume, points, affine, outside=0):
+    """
+    Nearest neighbour values of a volume at world points
+    :param volume: 3D array
+    :param points: (N, 3) world coordinates (RAS mm)
+    :param affine: (4, 4) voxel to world matrix of the volume
+    :param outside: value of the points falling outside the volume
+    :return: (N,) values
+    """
+    ijk, inside = voxel_indices(points, affine, volume.shape)
+    values = np.full(len(ijk), outside, dtype=volume.dtype)
+    values[inside] = volume[tuple(ijk[inside].T)]
+    return values
+
+
+def segment_samples(streamlines, step=None):
+    """
+    Points along every streamline, the segments longer than step are subdivided. A voxel only clipped by a segment
+    can fall between two samples, see voxel_samples for an exact voxel traversal
+    :param streamlines: Streamlines or list of arrays
+    :param step: maximum distance between two samples, only the vertices are returned when None
+    :return: (M, 3) float64 samples, (M,) index of the streamline of each sample
+    """
+    streamlines = as_streamlines(streamlines).pack()
+    points = streamlines.points.astype(np.float64)
+    ids = np.repeat(np.arange(len(streamlines)), streamlines.lengths)
+    if step is None:
+        return points, ids
+
+    same = ids[1:] == ids[:-1]
+    starts = points[:-1][same]
+    segments = np.diff(points, axis=0)[same]
+    counts = np.maximum(np.ceil(np.linalg.norm(segments, axis=1) / step), 1).astype(np.int64)
+    owner = np.repeat(np.arange(len(segments)), counts)
+    fractions = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / counts[owner].astype(
+        np.float64)
+    samples = starts[owner] + fractions[:, None] * segments[owner]
+
+    last = streamlines.offsets + streamlines.lengths - 1
+    last = last[streamlines.lengths > 0]
+    return np.concatenate((samples, points[last])), np.concatenate((ids[:-1][same][owner], ids[last]))
+
+
+def voxel_samples(streamlines, affine):
+    """
+    Points along every streamline, one in every voxel a segment goes through: the segments are cut where they cross
+    the voxel faces and the middle of every piece is kept, so that a voxel clipped at a corner is not skipped
+    :param streamlines: Streamlines or list of arrays
+    :param affine: voxel to world matrix of the grid
+    :return: (M, 3) float64 samples, (M,) index of the streamline of each sample
+    """
+    streamlines = as_streamlines(streamlines).pack()
+    points = apply_affine(np.linalg.inv(affine), streamlines.points)
+    ids = np.repeat(np.arange(len(streamlines)), streamlines.lengths)
+    same = ids[1:] == ids[:-1]
+    starts = points[:-1][same]
+    segments = np.diff(points, axis=0)[same]
+
+    #fraction of the segment at every voxel face crossing, the voxel centres being at integer coordinates
+    first_voxels = np.floor(starts + 0.5)
+    crossings = np.abs(np.floor(starts + segments + 0.5) - first_voxels).astype(np.int64)
+    owners, fractions = [np.arange(len(segments))], [np.zeros(len(segments))]
+    for axis in range(3):
+        counts = crossings[:, axis]
+        owner = np.repeat(np.arange(len(segments)), counts)
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        faces = first_voxels[owner, axis] + np.sign(segments[owner, axis]) * (ranks + 0.5)
+        owners.append(owner)
+        fractions.append((faces - starts[owner, axis]) / segments[owner, axis])
+    owners, fractions = np.concatenate(owners), np.concatenate(fractions)
+    order = np.lexsort((fractions, owners))
+    owners, fractions = owners[order], fractions[order]
+    #every piece ends at the next crossing of its segment, the last one at the segment end
+    ends = np.r_[fractions[1:], 1.]
+    ends[np.r_[owners[1:] != owners[:-1], True][:len(ends)]] = 1.
+    samples = starts[owners] + (0.5 * (fractions + ends))[:, None] * segments[owners]
+
+    last = streamlines.offsets + streamlines.lengths - 1
+    last = last[streamlines.lengths > 0]
+    return apply_affine(affine, np.concatenate((samples, points[last]))), \
+        np.concatenate((ids[:-1][same][owners], ids[last]))
+
+
+def voxel_streamline_pairs(streamlines, affine, shape, step=None):
+    """
+    (voxel, streamline) pairs of a tractogram, every voxel crossed by a streamline counted once
+    :param streamlines: Streamlines or list of arrays
+    :param affine: voxel to world matrix of the grid
+    :param shape: grid shape
+    :param step: sampling distance along the segments (see segment_samples), exact voxel traversal by default (see
+    voxel_samples)
+    :return: flat voxel indices, streamline indices, sorted by voxel then streamline
+    """
+    streamlines = as_streamlines(streamlines)
+    samples, ids = voxel_samples(streamlines, affine) if step is None else segment_samples(streamlines, step)
+    ijk, inside = voxel_indices(samples, affine, shape)
+    flat = np.ravel_multi_index(tuple(ijk[inside].T), shape)
+    ids = ids[inside]
+    #consecutive samples mostly fall in the same voxel, they are dropped before the (voxel, streamline) unique
+    new = np.r_[True, (flat[1:] != flat[:-1]) | (ids[1:] != ids[:-1])][:len(flat)]
+    keys = sorted_unique(flat[new] * len(streamlines) + ids[new])
+    return keys // len(streamlines), keys % len(streamlines)
+
+
+def sorted_unique(keys):
+    """
+    Sorted unique values of an integer array, sort based (np.unique can be much slower on large int64 arrays)
+    :param keys: 1D integer array
+    :return: sorted unique keys
+    """
+    keys = np.sort(keys)
+    return keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+
+
+def trilinear(volume, points, affine, outside=0.):
+    """
+    Trilinear interpolation of a volume at world points
+    :param volume: 3D array, or 4D with the components along the last axis
+    :param points: (N, 3) world coordinates (RAS mm)
+    :param affine: (4, 4) voxel to world matrix of the volume
+    :param outside: value of the points falling outside the volume
+    :return: (N,) values, (N, C) for 4D volumes
+    """
+    coordinates = apply_affine(np.linalg.inv(affine), points).T
+    if volume.ndim == 3:
+        return map_coordinates(volume, coordinates, order=1, mode='constant', cval=outside)
+    components = volume.reshape(volume.shape[:3] + (-1,))
+    return np.stack([map_coordinates(components[..., c], coordinates, order=1, mode='constant', cval=outside)
+                     for c in range(components.shape[3])], axis=1)
+
+
+def sample_maps(streamlines, maps, affine=None):
+    """
+    Scalar maps (e.g. FA, MD) interpolated at every point of a tractogram
+    :param streamlines: Streamlines or list of arrays
+    :param maps: dictionary name: 3D array, or name: (3D array, affine) when the maps are on different grids
+    :param affine: voxel to world matrix shared by the maps given without one
+    :return: dictionary name: (N,) float32 values in the packed order of the streamlines, see save_vtk point_data
+    """
+    points = as_streamlines(streamlines).pack().points
+    values = {}
+    for name, volume in maps.items():
+        volume, volume_affine = volume if isinstance(volume, tuple) else (volume, affine)
+        values[name] = trilinear(np.asarray(volume, dtype=np.float32), points, volume_affine).astype(np.float32)
+    return values
+
+
+def streamline_means(streamlines, values):
+    """
+    Mean of a per-point quantity over every streamline
+    :param streamlines: Streamlines or list of arrays
+    :param values: (N,) values in the packed order of the streamlines
+    :return: (count,) means, NaN for empty streamlines
+    """
+    lengths = as_streamlines(streamlines).lengths
+    means = np.full(len(lengths), np.nan)
+    filled = lengths > 0
+    offsets = np.r_[0, np.cumsum(lengths)][:-1]
+    means[filled] = np.add.reduceat(np.asarray(values, dtype=np.float64), offsets[filled]) / lengths[filled]
+    return means
@@ -0,0 +1,166 @@
+import time
+import numpy as np
+from .streamlines import as_streamlines
+from .metrics import streamline_lengths, mean_curvatures, direction_classes
+from .sampling import lookup, segment_samples, voxel_samples
+
+
+class SelectionPipeline(object):
+    """
+    Streamline predicates evaluated one after the other as boolean masks on a tractogram. Each predicate only sees
+    the streamlines accepted by the previous ones, the rejections and the time spent are reported per predicate
+    """
+
+    def __init__(self):
+        self.predicates = []
+        self.report = []
+
+    def __repr__(self):
+        return 'SelectionPipeline({})'.format(', '.join(name for name, _ in self.predicates))
+
+    def add(self, name, predicate):
+        """
+        :param name: name used in the report
+        :param predicate: function taking Streamlines and returning a boolean mask
+        :return: the pipeline, to chain the calls
+        """
+        self.predicates.append((name, predicate))
+        return self
+
+    def run(self, streamlines):
+        """
+        :param streamlines: Streamlines or list of arrays
+        :return: boolean mask of the streamlines accepted by every predicate
+        """
+        streamlines = as_streamlines(streamlines)
+        keep = np.ones(len(streamlines), dtype=bool)
+        self.report = []
+        for name, predicate in self.predicates:
+            start = time.time()
+            alive, = np.where(keep)
+            accepted = np.asarray(predicate(streamlines[alive]), dtype=bool)
+            keep[alive[~accepted]] = False
+            self.report.append({'name': name, 'tested': len(alive), 'rejected': int(len(alive) - accepted.sum()),
+                                'time': time.time() - start})
+        return keep
+
+    def select(self, streamlines):
+        streamlines = as_streamlines(streamlines)
+        return streamlines[self.run(streamlines)]
+
+
+def length_window(min_length=0., max_length=np.inf):
+    """
+    :param min_length: minimum length, mm
+    :param max_length: maximum length, mm
+    """
+    def predicate(streamlines):
+        lengths = streamline_lengths(streamlines)
+        return (lengths >= min_length) & (lengths <= max_length)
+    return predicate
+
+
+def curvature_limit(max_curvature):
+    """
+    :param max_curvature: maximum mean curvature, radians per mm
+    """
+    return lambda streamlines: mean_curvatures(streamlines) <= max_curvature
+
+
+def in_direction(dir, oblique=None):
+    """
+    :param dir: 0: ML, 1: AP, 2: SI, 3: oblique
+    :param oblique: see direction_classes
+    """
+    return lambda streamlines: direction_classes(streamlines, oblique) == dir
+
+
+def endpoints_in_labels(labelmap, affine, labels, both=True):
+    """
+    :param labelmap: 3D label array
+    :param affine: voxel to world matrix of the labelmap
+    :param labels: accepted labels
+    :param both: both endpoints must fall in the labels, one is enough otherwise (the empty streamlines are rejected)
+    """
+    def predicate(streamlines):
+        nonempty = streamlines.lengths > 0
+        first = streamlines.offsets[nonempty]
+        last = first + streamlines.lengths[nonempty] - 1
+        start = np.isin(lookup(labelmap, streamlines.points[first], affine), labels)
+        end = np.isin(lookup(labelmap, streamlines.points[last], affine), labels)
+        selected = np.zeros(len(streamlines), dtype=bool)
+        selected[nonempty] = start & end if both else start | end
+        return selected
+    return predicate
+
+
+def passes_through(roi, affine, exclude=False, step=None):
+    """
+    :param roi: 3D mask array
+    :param affine: voxel to world matrix of the mask
+    :param exclude: reject the streamlines entering the mask instead of keeping them
+    :param step: sampling distance along the segments, exact voxel traversal by default
+    """
+    def predicate(streamlines):
+        samples, ids = voxel_samples(streamlines, affine) if step is None else segment_samples(streamlines, step)
+        hit = np.zeros(len(streamlines), dtype=bool)
+        hit[ids[lookup(roi, samples, affine) > 0]] = True
+        return ~hit if exclude else hit
+    return predicate
+
+
+def stratified_order(streamlines, cell_size=10., seed=0):
+    """
+    Streamline order such that every prefix is a spatially stratified subsample: the streamlines are binned by the
+    grid cell of their middle point and taken one per cell in turn, in random order within each cell and with the
+    cells in a random order at every turn. Only the middle points are read, which is cheap on a memory-mapped
+    tractogram. The empty streamlines come last
+    :param streamlines: Streamlines or list of arrays
+    :param cell_size: grid spacing (mm)
+    :param seed: random generator seed
+    :return: permutation of the streamline indices
+    """
+    streamlines = as_streamlines(streamlines)
+    nonempty = np.flatnonzero(streamlines.lengths > 0)
+    middles = np.asarray(streamlines.points[streamlines.offsets[nonempty] + streamlines.lengths[nonempty] // 2],
+                         dtype=np.float64)
+    cells = np.floor(middles / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) if len(cells) else 0
+    keys = np.ravel_multi_index(tuple(cells.T), tuple(cells.max(axis=0) + 1)) if len(cells) else cells[:, 0]
+
+    random = np.random.RandomState(seed)
+    shuffled = random.permutation(len(nonempty))
+    order = shuffled[np.argsort(keys[shuffled], kind='mergesort')]
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    ranks = np.arange(len(order)) - np.repeat(starts, sizes)
+    #random cell priority, otherwise a prefix shorter than the number of cells would follow the ravel order
+    priorities = np.repeat(random.permutation(len(starts)), sizes)
+    return np.r_[nonempty[order[np.lexsort((priorities, ranks))]], np.flatnonzero(streamlines.lengths == 0)]
+
+
+def level_of_detail(streamlines, first=5000, factor=4, max_step=None, max_count=None, cell_size=10.):
+    """
+    Batches of a growing stratified subsample of a tractogram, see stratified_order: every batch only holds the
+    streamlines added to the previous level, so that a level is the union of the batches up to it
+    :param streamlines: Streamlines (e.g. memory-mapped from a tck file) or list of arrays
+    :param first: number of streamlines of the first level
+    :param factor: growth factor between two levels
+    :param max_step: largest number of streamlines of a batch, unbounded by default
+    :param max_count: number of streamlines of the last level, all of them by default
+    :param cell_size: stratification grid spacing (mm)
+    :return: iterator of packed Streamlines
+    """
+    streamlines = as_streamlines(streamlines)
+    order = stratified_order(streamlines, cell_size)
+    if max_count is not None:
+        order = order[:max_count]
+    previous, count = 0, min(first, len(order))
+    while True:
+        #sorted indices keep the reads sequential in the memory-mapped file
+        yield streamlines[np.sort(order[previous:count])].pack()
+        if count == len(order):
+            break
+        step = count * (factor - 1) if max_step is None else min(count * (factor - 1), max_step)
+        previous, count = count, min(count + step, len(order))
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class Streamlines(object):
+    """
+    Sequence of streamlines stored as views on a single points buffer. Indexing with an integer returns the vertices
+    of one streamline, slices, boolean masks and index arrays return new Streamlines sharing the same buffer
+    :param points: (N, 3) vertices array, can be a numpy memmap
+    :param offsets: index in points of the first vertex of every streamline
+    :param lengths: number of vertices of every streamline
+    """
+    __slots__ = ('points', 'offsets', 'lengths')
+
+    def __init__(self, points, offsets, lengths):
+        self.points = points
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    def __repr__(self):
+        return 'Streamlines(count={}, points={})'.format(len(self), self.number_of_points)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) or np.ndim(key):
+            if not isinstance(key, slice):
+                key = np.asarray(key)
+            return Streamlines(self.points, self.offsets[key], self.lengths[key])
+        start = int(self.offsets[key])
+        return self.points[start:start + int(self.lengths[key])]
+
+    def __iter__(self):
+        points = self.points
+        for start, length in zip(self.offsets.tolist(), self.lengths.tolist()):
+            yield points[start:start + length]
+
+    @property
+    def number_of_points(self):
+        return int(self.lengths.sum())
+
+    def pack(self, dtype=np.float32):
+        """
+        Streamlines stored one after the other, without gaps, in the points buffer
+        :param dtype: points dtype
+        :return: packed Streamlines, sharing the current buffer when it is already packed
+        """
+        offsets = lengths_to_offsets(self.lengths)
+        total = self.number_of_points
+        if len(self) and np.array_equal(self.offsets - self.offsets[0], offsets):
+            start = int(self.offsets[0])
+            points = self.points[start:start + total]
+        else:
+            points = self.points[np.arange(total) + np.repeat(self.offsets - offsets, self.lengths)]
+        return Streamlines(np.ascontiguousarray(points, dtype=dtype), offsets, self.lengths)
+
+
+def lengths_to_offsets(lengths):
+    """
+    Offsets of streamlines stored one after the other in a points buffer
+    :param lengths: number of vertices of every streamline
+    :return: index of the first vertex of every streamline
+    """
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    return offsets
+
+
+def as_streamlines(tracts, dtype=np.float32):
+    """
+    Streamlines from a list of (N_i, 3) arrays, Streamlines are returned unchanged
+    :param tracts: Streamlines or list of arrays
+    :param dtype: points dtype for lists
+    :return: Streamlines
+    """
+    if isinstance(tracts, Streamlines):
+        return tracts
+    lengths = np.array([len(t) for t in tracts], dtype=np.int64)
+    if len(tracts):
+        points = np.concatenate(tracts).astype(dtype)
+    else:
+        points = np.zeros((0, 3), dtype=dtype)
+    return Streamlines(points, lengths_to_offsets(lengths), lengths)
+
+
+def concatenate_streamlines(sequences, dtype=np.float32):
+    """
+    Streamlines of several sequences, in order, copied in a new packed buffer
+    :param sequences: list of Streamlines or lists of arrays
+    :param dtype: points dtype
+    :return: packed Streamlines
+    """
+    packed = [as_streamlines(s, dtype).pack(dtype) for s in sequences]
+    if not packed:
+        return as_streamlines([], dtype)
+    lengths = np.concatenate([s.lengths for s in packed])
+    points = np.concatenate([s.points for s in packed])
+    return Streamlines(points, lengths_to_offsets(lengths), lengths)
+
+
+def iter_batches(streamlines, chunk_size=50000):
+    """
+    Batches of a tractogram
+    :param streamlines: Streamlines, list of arrays, or an iterable of Streamlines batches (e.g. iter_tck) that is
+    returned as it is
+    :param chunk_size: number of streamlines of every batch
+    :return: iterator of Streamlines
+    """
+    if isinstance(streamlines, (list, tuple)):
+        streamlines = as_streamlines(streamlines)
+    if not isinstance(streamlines, Streamlines):
+        return iter(streamlines)
+    return (streamlines[start:start + chunk_size] for start in range(0, len(streamlines), chunk_size))
@@ -0,0 +1,100 @@
+import numpy as np
+import nibabel as nib
+from scipy.io import loadmat
+from .streamlines import Streamlines, as_streamlines, lengths_to_offsets, iter_batches
+from .sampling import apply_affine, trilinear
+from .input_output import read_mrtrix_header, iter_mrtrix_streamlines, TckWriter
+
+
+#ITK (ANTs) physical space is LPS, streamlines are RAS
+LPS_TO_RAS = np.diag([-1., -1., 1., 1.])
+
+
+def read_ants_affine(filename):
+    """
+    ANTs linear transform (e.g. out0GenericAffine.mat)
+    :param filename: ITK MATLAB transform file
+    :return: (4, 4) RAS matrix mapping the fixed image points (e.g. T2) to the moving image ones (e.g. DWI), its
+    inverse carries the moving space streamlines into the fixed space
+    """
+    transform = loadmat(filename)
+    parameters = next(transform[key] for key in transform if key.startswith('AffineTransform')).ravel()
+    center = transform['fixed'].ravel()
+    matrix = parameters[:9].reshape(3, 3)
+    lps = np.eye(4)
+    lps[:3, :3] = matrix
+    lps[:3, 3] = parameters[9:12] + center - np.dot(matrix, center)
+    return np.dot(LPS_TO_RAS, np.dot(lps, LPS_TO_RAS))
+
+
+def read_ants_warp(filename):
+    """
+    ANTs displacement field (e.g. out1Warp.nii.gz, out1InverseWarp.nii.gz)
+    :param filename: 5D NIfTI field of LPS displacements
+    :return: (X, Y, Z, 3) float32 RAS displacements, voxel to world matrix of the field
+    """
+    image = nib.load(filename)
+    field = np.asarray(image.dataobj, dtype=np.float32)
+    field = field.reshape(field.shape[:3] + (3,))
+    field[..., :2] *= -1
+    return field, image.affine
+
+
+def map_points(streamlines, function, chunk_size=50000):
+    """
+    Point-wise transformation of a tractogram, applied batch by batch in a preallocated float32 buffer
+    :param streamlines: Streamlines (e.g. memory-mapped from a tck file) or list of arrays
+    :param function: function of a (N, 3) points array returning the (N, 3) transformed points
+    :param chunk_size: number of streamlines transformed at once
+    :return: packed Streamlines
+    """
+    streamlines = as_streamlines(streamlines)
+    lengths = streamlines.lengths
+    points = np.empty((streamlines.number_of_points, 3), dtype=np.float32)
+    start = 0
+    for chunk in iter_batches(streamlines, chunk_size):
+        chunk_points = chunk.pack().points
+        points[start:start + len(chunk_points)] = function(chunk_points)
+        start += len(chunk_points)
+    return Streamlines(points, lengths_to_offsets(lengths), lengths)
+
+
+def transform_streamlines(streamlines, affine=None, field=None, field_affine=None, chunk_size=50000):
+    """
+    Streamlines carried in another space, by a 4x4 affine (e.g. from vtkmatrix_to_numpy or the inverse of
+    read_ants_affine) then by a displacement field
+    :param streamlines: Streamlines (e.g. memory-mapped from a tck file) or list of arrays
+    :param affine: (4, 4) RAS matrix applied first
+    :param field: (X, Y, Z, 3) RAS displacements applied last, see read_ants_warp
+    :param field_affine: voxel to world matrix of the field
+    :param chunk_size: number of streamlines transformed at once, bounds the interpolation memory
+    :return: packed float32 Streamlines
+    """
+    return map_points(streamlines, _transformation(affine, field, field_affine), chunk_size)
+
+
+def transform_tck(in_fpath, out_fpath, affine=None, field=None, field_affine=None, chunk_size=50000):
+    """
+    tck file carried in another space chunk by chunk, see transform_streamlines
+    :param in_fpath: input tck tractogram
+    :param out_fpath: output tck tractogram
+    """
+    function = _transformation(affine, field, field_affine)
+    header = read_mrtrix_header(in_fpath)
+    with TckWriter(out_fpath, header) as writer:
+        for chunk in iter_mrtrix_streamlines(in_fpath, header, chunk_size):
+            writer.write(Streamlines(function(chunk.points), chunk.offsets, chunk.lengths))
+
+
+def _transformation(affine=None, field=None, field_affine=None):
+    #contiguous components, so that the interpolation of every chunk does not copy the field
+    components = [] if field is None else [np.ascontiguousarray(field[..., c], dtype=np.float32) for c in range(3)]
+
+    def function(points):
+        if affine is not None:
+            points = apply_affine(affine, points)
+        if components:
+            #the points outside the field are not moved
+            points = points + np.stack([trilinear(c, points, field_affine) for c in components], axis=1)
+        return points
+    return function
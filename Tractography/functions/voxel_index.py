@@ -0,0 +1,106 @@
+import numpy as np
+from .streamlines import as_streamlines
+from .sampling import apply_affine, voxel_indices, voxel_streamline_pairs
+
+
+class VoxelIndex(object):
+    """
+    Inverted index from the voxels of an image grid (e.g. the DWI one) to the streamlines crossing them, in CSR form
+    :param shape: grid shape
+    :param affine: grid voxel to world matrix
+    :param voxels: sorted flat indices of the voxels crossed by at least one streamline
+    :param indptr: (len(voxels) + 1,) position in indices of the streamlines of every voxel
+    :param indices: sorted streamline indices of every voxel, one after the other
+    :param count: number of streamlines of the indexed tractogram
+    """
+
+    def __init__(self, shape, affine, voxels, indptr, indices, count):
+        self.shape = tuple(int(n) for n in shape[:3])
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.voxels = voxels
+        self.indptr = indptr
+        self.indices = indices
+        self.count = int(count)
+
+    def __repr__(self):
+        return 'VoxelIndex(shape={}, voxels={}, entries={}, count={})'.format(self.shape, len(self.voxels),
+                                                                             len(self.indices), self.count)
+
+    @classmethod
+    def build(cls, streamlines, affine, shape, step=None, chunk_size=50000):
+        """
+        :param streamlines: Streamlines (e.g. memory-mapped from a tck file) or list of arrays
+        :param affine: voxel to world matrix of the grid
+        :param shape: grid shape
+        :param step: sampling distance along the segments, exact voxel traversal by default
+        :param chunk_size: number of streamlines voxelized at once
+        :return: VoxelIndex
+        """
+        streamlines = as_streamlines(streamlines)
+        shape = tuple(int(n) for n in shape[:3])
+
+        voxels, indices = [], []
+        for start in range(0, len(streamlines), chunk_size):
+            chunk = streamlines[start:start + chunk_size]
+            flat, ids = voxel_streamline_pairs(chunk, affine, shape, step)
+            voxels.append(flat)
+            indices.append(ids + start)
+
+        voxels = np.concatenate(voxels) if voxels else np.zeros(0, dtype=np.int64)
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        order = np.argsort(voxels, kind='mergesort')
+        voxels, counts = np.unique(voxels[order], return_counts=True)
+        indptr = np.r_[0, np.cumsum(counts)].astype(np.int64)
+        return cls(shape, affine, voxels, indptr, indices[order], len(streamlines))
+
+    def save(self, filename):
+        np.savez(filename, shape=np.array(self.shape), affine=self.affine, voxels=self.voxels, indptr=self.indptr,
+                 indices=self.indices, count=np.array(self.count))
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['shape'], data['affine'], data['voxels'], data['indptr'], data['indices'], data['count'])
+
+    def _flat_voxels(self, mask, affine=None):
+        mask = np.asarray(mask)
+        if affine is None or (mask.shape[:3] == self.shape and np.allclose(affine, self.affine)):
+            return np.flatnonzero(mask.reshape(self.shape) > 0)
+        #mask defined on another grid: its voxel centres are moved in the index grid
+        ijk, inside = voxel_indices(apply_affine(affine, np.argwhere(mask > 0)), self.affine, self.shape)
+        return np.unique(np.ravel_multi_index(tuple(ijk[inside].T), self.shape))
+
+    def streamlines_in(self, mask, affine=None):
+        """
+        :param mask: 3D ROI array, voxels > 0 belong to the ROI
+        :param affine: voxel to world matrix of the mask, needed only if it is not defined on the index grid
+        :return: sorted indices of the streamlines crossing the ROI
+        """
+        flat = self._flat_voxels(mask, affine)
+        positions = np.searchsorted(self.voxels, flat)
+        found = positions < len(self.voxels)
+        found[found] = self.voxels[positions[found]] == flat[found]
+        positions = positions[found]
+        starts = self.indptr[positions]
+        counts = self.indptr[positions + 1] - starts
+        entries = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.unique(self.indices[entries])
+
+    def query(self, include=(), exclude=(), affine=None):
+        """
+        Streamlines crossing every include ROI and none of the exclude ROIs
+        :param include: list of 3D masks (or a single one)
+        :param exclude: list of 3D masks (or a single one)
+        :param affine: voxel to world matrix of the masks, needed only if they are not defined on the index grid
+        :return: sorted streamline indices
+        """
+        if isinstance(include, np.ndarray):
+            include = [include]
+        if isinstance(exclude, np.ndarray):
+            exclude = [exclude]
+        selected = np.arange(self.count)
+        for mask in include:
+            selected = np.intersect1d(selected, self.streamlines_in(mask, affine), assume_unique=True)
+        for mask in exclude:
+            selected = np.setdiff1d(selected, self.streamlines_in(mask, affine), assume_unique=True)
+        return selected